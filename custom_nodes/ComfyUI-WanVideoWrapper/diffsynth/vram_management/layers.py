@@ -1,10 +1,65 @@
-import torch, copy
+import torch, copy, itertools
 from .utils import init_weights_on_device
 
 
+_onload_streams = {}
+
+
+def get_onload_stream(device):
+    device = torch.device(device)
+    if device not in _onload_streams:
+        _onload_streams[device] = torch.cuda.Stream(device=device)
+    return _onload_streams[device]
+
+
+def pin_parameters(module):
+    # pinned host memory lets the non_blocking copies in cast_to run asynchronously, the tensors are
+    # views into one pinned allocation per module since the caching host allocator rounds every
+    # pinned allocation up to a power of two
+    if not torch.cuda.is_available():
+        return None
+    tensors = [t for t in itertools.chain(module.parameters(), module.buffers()) if t.device.type == "cpu" and type(t.data) is torch.Tensor]
+    if not tensors:
+        return None
+    align = 64
+    sizes = [(t.numel() * t.element_size() + align - 1) // align * align for t in tensors]
+    pool = torch.empty(sum(sizes), dtype=torch.uint8, pin_memory=True)
+    views = []
+    offset = 0
+    for t, size in zip(tensors, sizes):
+        view = pool[offset:offset + t.numel() * t.element_size()].view(t.dtype).view(t.shape)
+        view.copy_(t.data)
+        t.data = view
+        views.append(view)
+        offset += size
+    return list(zip(tensors, views))
+
+
+def offload_to_pinned(pinned_views):
+    # copies the onloaded tensors back into the pinned pool from pin_parameters instead of
+    # allocating new host memory, returns False when there is no pool to copy into
+    if pinned_views is None:
+        return False
+    for t, view in pinned_views:
+        if t.data is not view:
+            view.copy_(t.data)
+            t.data = view
+    return True
+
+
 def cast_to(weight, dtype, device):
-    r = torch.empty_like(weight, dtype=dtype, device=device)
-    r.copy_(weight)
+    device = torch.device(device)
+    if device.type != "cuda" or weight.device.type != "cpu":
+        r = torch.empty_like(weight, dtype=dtype, device=device)
+        r.copy_(weight)
+        return r
+    # copy on a side stream so the transfer overlaps with compute still queued on the current stream
+    stream = get_onload_stream(device)
+    current_stream = torch.cuda.current_stream(device)
+    with torch.cuda.stream(stream):
+        r = weight.to(device=device, dtype=dtype, non_blocking=True)
+    current_stream.wait_stream(stream)
+    r.record_stream(current_stream)
     return r
 
 
@@ -19,10 +74,12 @@ class AutoWrappedModule(torch.nn.Module):
         self.computation_dtype = computation_dtype
         self.computation_device = computation_device
         self.state = 0
+        self.pinned_views = pin_parameters(self.module)
 
     def offload(self):
         if self.state == 1 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
-            self.module.to(dtype=self.offload_dtype, device=self.offload_device)
+            if not offload_to_pinned(self.pinned_views):
+                self.module.to(dtype=self.offload_dtype, device=self.offload_device)
             self.state = 0
 
     def onload(self):
@@ -51,10 +108,12 @@ class AutoWrappedLinear(torch.nn.Linear):
         self.computation_dtype = computation_dtype
         self.computation_device = computation_device
         self.state = 0
+        self.pinned_views = pin_parameters(self)
 
     def offload(self):
         if self.state == 1 and (self.offload_dtype != self.onload_dtype or self.offload_device != self.onload_device):
-            self.to(dtype=self.offload_dtype, device=self.offload_device)
+            if not offload_to_pinned(self.pinned_views):
+                self.to(dtype=self.offload_dtype, device=self.offload_device)
             self.state = 0
 
     def onload(self):
@@ -28,12 +28,41 @@ def fp8_linear_forward(cls, original_dtype, input):
     else:
         return cls.original_forward(input)
 
-def convert_fp8_linear(module, original_dtype, params_to_keep={}):
+def quantize_fp8_rowwise(weight):
+    # one scale per output row, so outlier rows don't flatten the rest of the matrix
+    weight = weight.float()
+    scale = (weight.abs().amax(dim=1, keepdim=True) / 448.0).clamp(min=1e-12)
+    weight_fp8 = (weight / scale).clamp(-448.0, 448.0).to(torch.float8_e4m3fn)
+    return weight_fp8, scale.t().contiguous()
+
+def fp8_linear_rowwise_forward(cls, original_dtype, input):
+    bias = cls.bias.to(original_dtype) if cls.bias is not None else None
+    if len(input.shape) == 3:
+        inn = input.reshape(-1, input.shape[2])
+        input_scale = (inn.abs().amax(dim=1, keepdim=True).float() / 448.0).clamp(min=1e-12)
+        inn = (inn / input_scale).clamp(-448.0, 448.0).to(torch.float8_e4m3fn)
+
+        o = torch._scaled_mm(inn, cls.weight.t(), out_dtype=original_dtype, bias=bias, scale_a=input_scale, scale_b=cls.weight_scale)
+
+        if isinstance(o, tuple):
+            o = o[0]
+
+        return o.reshape((-1, input.shape[1], cls.weight.shape[0]))
+    else:
+        weight = cls.weight.to(original_dtype) * cls.weight_scale.t().to(original_dtype)
+        return torch.nn.functional.linear(input.to(original_dtype), weight, bias)
+
+def convert_fp8_linear(module, original_dtype, params_to_keep={}, row_scales=None):
     setattr(module, "fp8_matmul_enabled", True)
    
     for name, module in module.named_modules():
         if not any(keyword in name for keyword in params_to_keep):
-            if isinstance(module, nn.Linear):
+            if isinstance(module, nn.Linear) and row_scales is not None and f"{name}.weight" in row_scales:
+                # kept as a buffer so it moves along with the weight when the block is swapped
+                module.register_buffer("weight_scale", row_scales[f"{name}.weight"].to(module.weight.device))
+                setattr(module, "original_forward", module.forward)
+                setattr(module, "forward", lambda input, m=module: fp8_linear_rowwise_forward(m, original_dtype, input))
+            elif isinstance(module, nn.Linear):
                 original_forward = module.forward
                 setattr(module, "original_forward", original_forward)
                 setattr(module, "forward", lambda input, m=module: fp8_linear_forward(m, original_dtype, input))
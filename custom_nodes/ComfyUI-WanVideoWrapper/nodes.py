@@ -1,7 +1,12 @@
 import os
+import re
+import copy
+import functools
+import weakref
+from collections import OrderedDict
 import torch
 import gc
-from .utils import log, print_memory, apply_lora
+from .utils import log, print_memory, apply_lora, load_state_dict_lazy, strip_key_prefix, assign_module_tensor, LazySafetensorsDict
 import numpy as np
 import math
 from tqdm import tqdm
@@ -31,11 +36,10 @@ from comfy.sd import load_lora_for_models
 script_directory = os.path.dirname(os.path.abspath(__file__))
 
 def add_noise_to_reference_video(image, ratio=None):
-    sigma = torch.ones((image.shape[0],)).to(image.device, image.dtype) * ratio 
-    image_noise = torch.randn_like(image) * sigma[:, None, None, None]
-    image_noise = torch.where(image==-1, torch.zeros_like(image), image_noise)
-    image = image + image_noise
-    return image
+    # adds noise in place, callers pass a tensor they own
+    image_noise = torch.randn_like(image).mul_(ratio)
+    image_noise.masked_fill_(image == -1, 0.0)
+    return image.add_(image_noise)
 
 class WanVideoBlockSwap:
     @classmethod
@@ -132,16 +136,33 @@ Official recommended values https://github.com/ali-vilab/TeaCache/tree/main/TeaC
         return (teacache_args,)
 
 
+class WanVideoPipelineState:
+    __slots__ = ("dtype", "base_path", "model_name", "manual_offloading", "quantization", "block_swap_args", "auto_cpu_offload", "vram_managed_modules")
+
+    def __init__(self):
+        for k in self.__slots__:
+            setattr(self, k, None)
+
+    def update(self, values):
+        for k, v in values.items():
+            setattr(self, k, v)
+
 class WanVideoModel(comfy.model_base.BaseModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.pipeline = {}
+        self.pipeline = WanVideoPipelineState()
 
     def __getitem__(self, k):
-        return self.pipeline[k]
+        try:
+            return getattr(self.pipeline, k)
+        except AttributeError:
+            raise KeyError(k)
 
     def __setitem__(self, k, v):
-        self.pipeline[k] = v
+        try:
+            setattr(self.pipeline, k, v)
+        except AttributeError:
+            raise KeyError(k)
 
 try:
     from comfy.latent_formats import Wan21
@@ -164,50 +185,58 @@ class WanVideoModelConfig:
         # denoiser is handled by extension
         self.unet_config["disable_unet_model_creation"] = True
 
+_LORA_BLOCK_RE = re.compile(r"diffusion_model\.(blocks\.\d+\.)")
+
 def filter_state_dict_by_blocks(state_dict, blocks_mapping):
-    filtered_dict = {}
+    if isinstance(state_dict, LazySafetensorsDict):
+        def keep(key):
+            m = _LORA_BLOCK_RE.search(key)
+            return m is not None and m.group(1) in blocks_mapping
+        state_dict.filter_keys(keep)
+        return state_dict
 
-    for key in state_dict:
-        if 'blocks.' in key:
-            block_pattern = key.split('diffusion_model.')[1].split('.', 2)[0:2]
-            block_key = f'{block_pattern[0]}.{block_pattern[1]}.'
+    filtered_dict = {}
 
-            if block_key in blocks_mapping:
-                filtered_dict[key] = state_dict[key]
+    for key, value in state_dict.items():
+        m = _LORA_BLOCK_RE.search(key)
+        if m is not None and m.group(1) in blocks_mapping:
+            filtered_dict[key] = value
 
     return filtered_dict
 
+# Diffusers prefix and fused attention projections (HunyuanVideo style)
+_LORA_KEY_SUBS = {
+    "transformer.": "diffusion_model.",
+    "img_attn.proj": "img_attn_proj",
+    "img_attn.qkv": "img_attn_qkv",
+    "txt_attn.proj": "txt_attn_proj",
+    "txt_attn.qkv": "txt_attn_qkv",
+}
+_LORA_KEY_RE = re.compile(r"^transformer\.|(?:img|txt)_attn\.(?:proj|qkv)")
+
+# finetrainer format, only rewritten on keys that contain .attn1. or .attn2.
+_LORA_ATTN_SUBS = {
+    ".attn1": ".cross_attn",
+    ".attn2": ".cross_attn",
+    ".to_k": ".k",
+    ".to_q": ".q",
+    ".to_v": ".v",
+    ".to_out.0": ".o",
+}
+_LORA_ATTN_RE = re.compile(r"\.attn[12](?=\.)|\.to_[kqv](?=\.)|\.to_out\.0(?=\.)")
+_LORA_HAS_ATTN_RE = re.compile(r"\.attn[12]\.")
+
+def _standardize_lora_key(k):
+    k = _LORA_KEY_RE.sub(lambda m: _LORA_KEY_SUBS[m.group(0)], k)
+    if _LORA_HAS_ATTN_RE.search(k):
+        k = _LORA_ATTN_RE.sub(lambda m: _LORA_ATTN_SUBS[m.group(0)], k)
+    return k
+
 def standardize_lora_key_format(lora_sd):
-    new_sd = {}
-    for k, v in lora_sd.items():
-        # Diffusers format
-        if k.startswith('transformer.'):
-            k = k.replace('transformer.', 'diffusion_model.')
-            
-        # from finetrainer format
-        if '.attn1.' in k:
-            k = k.replace('.attn1.', '.cross_attn.')
-            k = k.replace('.to_k.', '.k.')
-            k = k.replace('.to_q.', '.q.')
-            k = k.replace('.to_v.', '.v.')
-            k = k.replace('.to_out.0.', '.o.')
-        elif '.attn2.' in k:
-            k = k.replace('.attn2.', '.cross_attn.')
-            k = k.replace('.to_k.', '.k.')
-            k = k.replace('.to_q.', '.q.')
-            k = k.replace('.to_v.', '.v.')
-            k = k.replace('.to_out.0.', '.o.')
-            
-        if "img_attn.proj" in k:
-            k = k.replace("img_attn.proj", "img_attn_proj")
-        if "img_attn.qkv" in k:
-            k = k.replace("img_attn.qkv", "img_attn_qkv")
-        if "txt_attn.proj" in k:
-            k = k.replace("txt_attn.proj ", "txt_attn_proj")
-        if "txt_attn.qkv" in k:
-            k = k.replace("txt_attn.qkv", "txt_attn_qkv")
-        new_sd[k] = v
-    return new_sd
+    if isinstance(lora_sd, LazySafetensorsDict):
+        lora_sd.rename_keys(_standardize_lora_key)
+        return lora_sd
+    return {_standardize_lora_key(k): v for k, v in lora_sd.items()}
 
 class WanVideoEnhanceAVideo:
     @classmethod
@@ -270,15 +299,11 @@ class WanVideoLoraBlockEdit:
     def __init__(self):
         self.loaded_lora = None
 
+    _INPUT_TYPES = {"required": dict.fromkeys(("blocks.{}.".format(i) for i in range(40)), ("BOOLEAN", {"default": True}))}
+
     @classmethod
     def INPUT_TYPES(s):
-        arg_dict = {}
-        argument = ("BOOLEAN", {"default": True})
-
-        for i in range(40):
-            arg_dict["blocks.{}.".format(i)] = argument
-
-        return {"required": arg_dict}
+        return s._INPUT_TYPES
 
     RETURN_TYPES = ("SELECTEDBLOCKS", )
     RETURN_NAMES = ("blocks", )
@@ -293,6 +318,15 @@ class WanVideoLoraBlockEdit:
         return (selected_blocks,)
 
 #region Model loading
+def _compile_block_forward(block, dynamo_config, **compile_kwargs):
+    # the dynamo settings are only patched in while the compiled forward runs, which is when dynamo
+    # actually traces, so loading a model doesn't change them for every other compile in the process
+    dynamo_config = {k: v for k, v in dynamo_config.items() if hasattr(torch._dynamo.config, k)}
+    block.forward = torch._dynamo.config.patch(**dynamo_config)(torch.compile(block.forward, **compile_kwargs))
+
+_BASE_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp16_fast": torch.float16, "fp32": torch.float32}
+_QUANT_DTYPES = {"fp8_e4m3fn": torch.float8_e4m3fn, "fp8_e4m3fn_fast": torch.float8_e4m3fn, "fp8_scaled": torch.float8_e4m3fn, "fp8_e5m2": torch.float8_e5m2}
+
 class WanVideoModelLoader:
     @classmethod
     def INPUT_TYPES(s):
@@ -336,8 +370,8 @@ class WanVideoModelLoader:
         transformer = None
         mm.unload_all_models()
         mm.cleanup_models()
-        mm.soft_empty_cache()
         manual_offloading = True
+        vram_managed_modules = []
         if "sage" in attention_mode:
             try:
                 from sageattention import sageattn
@@ -351,7 +385,9 @@ class WanVideoModelLoader:
         manual_offloading = True
         transformer_load_device = device if load_device == "main_device" else offload_device
         
-        base_dtype = {"fp8_e4m3fn": torch.float8_e4m3fn, "fp8_e4m3fn_fast": torch.float8_e4m3fn, "bf16": torch.bfloat16, "fp16": torch.float16, "fp16_fast": torch.float16, "fp32": torch.float32}[base_precision]
+        if base_precision not in _BASE_DTYPES:
+            raise ValueError(f"Unsupported base precision: {base_precision}, expected one of {list(_BASE_DTYPES)}")
+        base_dtype = _BASE_DTYPES[base_precision]
         
         if base_precision == "fp16_fast":
             if hasattr(torch.backends.cuda.matmul, "allow_fp16_accumulation"):
@@ -366,15 +402,11 @@ class WanVideoModelLoader:
                 pass
 
         model_path = folder_paths.get_full_path_or_raise("diffusion_models", model)
-        sd = load_torch_file(model_path, device=transformer_load_device, safe_load=True)
+        sd = load_state_dict_lazy(model_path, transformer_load_device)
 
         first_key = next(iter(sd))
         if first_key.startswith("model.diffusion_model."):
-            new_sd = {}
-            for key, value in sd.items():
-                new_key = key.replace("model.diffusion_model.", "", 1)
-                new_sd[new_key] = value
-            sd = new_sd
+            sd = strip_key_prefix(sd, "model.diffusion_model.")
 
         dim = sd["patch_embedding.weight"].shape[0]
         in_channels = sd["patch_embedding.weight"].shape[1]
@@ -427,24 +459,47 @@ class WanVideoModelLoader:
           
 
         if not "torchao" in quantization:
-            if quantization == "fp8_e4m3fn" or quantization == "fp8_e4m3fn_fast" or quantization == "fp8_scaled":
-                dtype = torch.float8_e4m3fn
-            elif quantization == "fp8_e5m2":
-                dtype = torch.float8_e5m2
-            else:
-                dtype = base_dtype
+            dtype = _QUANT_DTYPES.get(quantization, base_dtype)
             params_to_keep = {"norm", "head", "bias", "time_in", "vector_in", "patch_embedding", "time_", "img_emb", "modulation"}
+            params_to_keep_re = re.compile("|".join(map(re.escape, params_to_keep)))
             #if lora is not None:
             #    transformer_load_device = device
+            # ffn weights get a per-row scale for the fast fp8 matmul, LoRA patching would apply its deltas in the wrong scale
+            fp8_row_scales = None
+            if (quantization == "fp8_e4m3fn_fast" and base_dtype == torch.bfloat16 and lora is None and vram_management_args is None
+                and torch.cuda.is_available() and torch.cuda.get_device_capability(device) >= (9, 0)):
+                from .fp8_optimization import quantize_fp8_rowwise
+                fp8_row_scales = {}
             if not lora_low_mem_load:
                 log.info("Using accelerate to load and assign model weights to device...")
                 param_count = sum(1 for _ in transformer.named_parameters())
+                # issue the copies/casts on a side stream from pinned memory so they don't block on each parameter
+                copy_stream = None
+                if transformer_load_device.type == "cuda":
+                    copy_stream = torch.cuda.Stream(device=transformer_load_device)
+                    copy_stream.wait_stream(torch.cuda.current_stream(transformer_load_device))
                 for name, param in tqdm(transformer.named_parameters(), 
                        desc=f"Loading transformer parameters to {transformer_load_device}", 
                        total=param_count,
                        leave=True):
-                    dtype_to_use = base_dtype if any(keyword in name for keyword in params_to_keep) else dtype
-                    set_module_tensor_to_device(transformer, name, device=transformer_load_device, dtype=dtype_to_use, value=sd[name])
+                    dtype_to_use = base_dtype if params_to_keep_re.search(name) else dtype
+                    rowwise = fp8_row_scales is not None and dtype_to_use == torch.float8_e4m3fn and ".ffn." in name and name.endswith(".weight")
+                    if copy_stream is not None:
+                        # lazily loaded tensors are read onto the device here, so that read goes on the side stream too
+                        with torch.cuda.stream(copy_stream):
+                            value = sd.pop(name)
+                            if value.device.type == "cpu" and not value.is_pinned():
+                                value = value.pin_memory()
+                            value = value.to(transformer_load_device, dtype=base_dtype if rowwise else dtype_to_use, non_blocking=True)
+                            if rowwise:
+                                value, fp8_row_scales[name] = quantize_fp8_rowwise(value)
+                    else:
+                        value = sd.pop(name)
+                        if rowwise:
+                            value, fp8_row_scales[name] = quantize_fp8_rowwise(value.to(transformer_load_device))
+                    set_module_tensor_to_device(transformer, name, device=transformer_load_device, dtype=dtype_to_use, value=value)
+                if copy_stream is not None:
+                    copy_stream.synchronize()
 
             comfy_model.diffusion_model = transformer
             comfy_model.load_device = transformer_load_device
@@ -457,10 +512,12 @@ class WanVideoModelLoader:
                     log.info(f"Loading LoRA: {l['name']} with strength: {l['strength']}")
                     lora_path = l["path"]
                     lora_strength = l["strength"]
-                    lora_sd = load_torch_file(lora_path, safe_load=True)
+                    lora_sd = load_state_dict_lazy(lora_path, "cpu")
                     lora_sd = standardize_lora_key_format(lora_sd)
                     if l["blocks"]:
                         lora_sd = filter_state_dict_by_blocks(lora_sd, l["blocks"])
+                    # only the tensors that survived the renaming and filtering are read from disk
+                    lora_sd = dict(lora_sd.items())
 
                     #spacepxl's control LoRA patch
                     # for key in lora_sd.keys():
@@ -481,11 +538,11 @@ class WanVideoModelLoader:
                             transformer.patch_embedding.padding,
                         ).to(device=device, dtype=torch.bfloat16)
                         
-                        new_in.weight.zero_()
-                        new_in.bias.zero_()
-                        
-                        new_in.weight[:, :old_in_dim].copy_(transformer.patch_embedding.weight)
-                        new_in.bias.copy_(transformer.patch_embedding.bias)
+                        with torch.no_grad():
+                            old_weight = transformer.patch_embedding.weight
+                            extra_channels = old_weight.new_zeros(old_weight.shape[0], new_in_dim - old_in_dim, *old_weight.shape[2:])
+                            new_in.weight.copy_(torch.cat([old_weight, extra_channels], dim=1))
+                            new_in.bias.copy_(transformer.patch_embedding.bias)
                         
                         transformer.patch_embedding = new_in
                         transformer.expanded_patch_embedding = new_in
@@ -505,7 +562,7 @@ class WanVideoModelLoader:
                 from .fp8_optimization import convert_fp8_linear
                 #params_to_keep.update({"ffn"})
                 print(params_to_keep)
-                convert_fp8_linear(patcher.model.diffusion_model, base_dtype, params_to_keep=params_to_keep)
+                convert_fp8_linear(patcher.model.diffusion_model, base_dtype, params_to_keep=params_to_keep, row_scales=fp8_row_scales)
 
             if vram_management_args is not None:
                 from .diffsynth.vram_management import enable_vram_management, AutoWrappedModule, AutoWrappedLinear
@@ -547,6 +604,8 @@ class WanVideoModelLoader:
                     ),
                     compile_args = compile_args,
                 )
+                # collected once here so the sampler doesn't walk the whole module tree to reset them
+                vram_managed_modules = [m for m in patcher.model.diffusion_model.modules() if isinstance(m, (AutoWrappedModule, AutoWrappedLinear))]
 
             #compile
             if compile_args is not None and vram_management_args is None:
@@ -560,8 +619,6 @@ class WanVideoModelLoader:
             if load_device == "offload_device" and patcher.model.diffusion_model.device != offload_device:
                 log.info(f"Moving diffusion model from {patcher.model.diffusion_model.device} to {offload_device}")
                 patcher.model.diffusion_model.to(offload_device)
-                gc.collect()
-                mm.soft_empty_cache()
 
         elif "torchao" in quantization:
             try:
@@ -604,15 +661,18 @@ class WanVideoModelLoader:
                 log.info(f"Quantizing block {i}")
                 for name, _ in block.named_parameters(prefix=f"blocks.{i}"):
                     #print(f"Parameter name: {name}")
-                    set_module_tensor_to_device(patcher.model.diffusion_model, name, device=transformer_load_device, dtype=base_dtype, value=sd[name])
-                if compile_args is not None:
-                    patcher.model.diffusion_model.blocks[i] = torch.compile(block, fullgraph=compile_args["fullgraph"], dynamic=compile_args["dynamic"], backend=compile_args["backend"], mode=compile_args["mode"])
+                    assign_module_tensor(patcher.model.diffusion_model, name, sd.pop(name), transformer_load_device, base_dtype)
                 quantize_(block, quant_func)
-                print(block)
                 #block.to(offload_device)
+            if compile_args is not None:
+                # all blocks share the same structure, with nn modules inlined dynamo guards on the code instead of the
+                # module instance so the graph compiled for the first block is reused by the rest instead of recompiling per block
+                dynamo_config = {"cache_size_limit": compile_args["dynamo_cache_size_limit"], "inline_inbuilt_nn_modules": True}
+                for block in patcher.model.diffusion_model.blocks:
+                    _compile_block_forward(block, dynamo_config, fullgraph=compile_args["fullgraph"], dynamic=compile_args["dynamic"], backend=compile_args["backend"], mode=compile_args["mode"])
             for name, param in patcher.model.diffusion_model.named_parameters():
                 if "blocks" not in name:
-                    set_module_tensor_to_device(patcher.model.diffusion_model, name, device=transformer_load_device, dtype=base_dtype, value=sd[name])
+                    assign_module_tensor(patcher.model.diffusion_model, name, sd.pop(name), transformer_load_device, base_dtype)
 
             manual_offloading = False # to disable manual .to(device) calls
             log.info(f"Quantized transformer blocks to {quantization}")
@@ -621,24 +681,46 @@ class WanVideoModelLoader:
                 #param.data = param.data.to(self.vae_dtype).to(device)
 
             del sd
-            mm.soft_empty_cache()
 
-        patcher.model["dtype"] = base_dtype
-        patcher.model["base_path"] = model_path
-        patcher.model["model_name"] = model
-        patcher.model["manual_offloading"] = manual_offloading
-        patcher.model["quantization"] = "disabled"
-        patcher.model["block_swap_args"] = block_swap_args
-        patcher.model["auto_cpu_offload"] = True if vram_management_args is not None else False
+        # a single cache flush once loading is done, each one syncs the device
+        gc.collect()
+        mm.soft_empty_cache()
 
-        for model in mm.current_loaded_models:
-            if model._model() == patcher:
-                mm.current_loaded_models.remove(model)            
+        patcher.model.pipeline.update({
+            "dtype": base_dtype,
+            "base_path": model_path,
+            "model_name": model,
+            "manual_offloading": manual_offloading,
+            "quantization": "disabled",
+            "block_swap_args": block_swap_args,
+            "auto_cpu_offload": vram_management_args is not None,
+            "vram_managed_modules": vram_managed_modules,
+        })
+
+        # single pass instead of removing while iterating, which skips entries
+        mm.current_loaded_models[:] = [m for m in mm.current_loaded_models if m._model() is not patcher]
 
         return (patcher,)
 
 #region load VAE
 
+_DTYPE_MAP = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
+
+# models built by the loaders below, so re-executing a loader with unchanged inputs doesn't re-read the file
+_MODEL_CACHE = OrderedDict()
+_MODEL_CACHE_SIZE = 4
+
+def _cached_load(key, build_fn):
+    ref = _MODEL_CACHE.get(key)
+    model = ref() if ref is not None else None
+    if model is None:
+        model = build_fn()
+        _MODEL_CACHE[key] = weakref.ref(model)
+    _MODEL_CACHE.move_to_end(key)
+    while len(_MODEL_CACHE) > _MODEL_CACHE_SIZE:
+        _MODEL_CACHE.popitem(last=False)
+    return model
+
 class WanVideoVAELoader:
     @classmethod
     def INPUT_TYPES(s):
@@ -665,21 +747,25 @@ class WanVideoVAELoader:
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
 
-        dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
+        dtype = _DTYPE_MAP[precision]
         #with open(os.path.join(script_directory, 'configs', 'hy_vae_config.json')) as f:
         #    vae_config = json.load(f)
         model_path = folder_paths.get_full_path("vae", model_name)
-        vae_sd = load_torch_file(model_path, safe_load=True)
 
-        has_model_prefix = any(k.startswith("model.") for k in vae_sd.keys())
-        if not has_model_prefix:
-            vae_sd = {f"model.{k}": v for k, v in vae_sd.items()}
-        
-        vae = WanVideoVAE(dtype=dtype)
-        vae.load_state_dict(vae_sd)
-        vae.eval()
-        vae.to(device = offload_device, dtype = dtype)
+        def build():
+            vae_sd = load_torch_file(model_path, safe_load=True)
+
+            has_model_prefix = any(k.startswith("model.") for k in vae_sd.keys())
+            if not has_model_prefix:
+                vae_sd = {f"model.{k}": v for k, v in vae_sd.items()}
             
+            vae = WanVideoVAE(dtype=dtype)
+            vae.load_state_dict(vae_sd)
+            vae.eval()
+            vae.to(device = offload_device, dtype = dtype)
+            return vae
+
+        vae = _cached_load(("vae", model_path, os.path.getmtime(model_path), dtype), build)
 
         return (vae,)
 
@@ -709,13 +795,18 @@ class WanVideoTinyVAELoader:
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
 
-        dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
+        dtype = _DTYPE_MAP[precision]
         model_path = folder_paths.get_full_path("vae_approx", model_name)
-        vae_sd = load_torch_file(model_path, safe_load=True)
-        
-        vae = TAEHV(vae_sd)
-       
-        vae.to(device = offload_device, dtype = dtype)
+
+        def build():
+            vae_sd = load_torch_file(model_path, safe_load=True)
+            
+            vae = TAEHV(vae_sd)
+           
+            vae.to(device = offload_device, dtype = dtype)
+            return vae
+
+        vae = _cached_load(("tiny_vae", model_path, os.path.getmtime(model_path), dtype), build)
 
         return (vae,)
 
@@ -768,7 +859,8 @@ class LoadWanVideoT5TextEncoder:
             },
             "optional": {
                 "load_device": (["main_device", "offload_device"], {"default": "offload_device"}),
-                "quantization": (['disabled', 'fp8_e4m3fn'], {"default": 'disabled', "tooltip": "optional quantization method"}),
+                "quantization": (['disabled', 'fp8_e4m3fn', 'torchao_int8'], {"default": 'disabled', "tooltip": "optional quantization method, torchao_int8 is int8 weight-only and requires torchao"}),
+                "compile": ("BOOLEAN", {"default": False, "tooltip": "torch.compile the encoder blocks, they are identical so the graph is only compiled once. Requires Triton"}),
             }
         }
 
@@ -778,7 +870,7 @@ class LoadWanVideoT5TextEncoder:
     CATEGORY = "WanVideoWrapper"
     DESCRIPTION = "Loads Wan text_encoder model from 'ComfyUI/models/LLM'"
 
-    def loadmodel(self, model_name, precision, load_device="offload_device", quantization="disabled"):
+    def loadmodel(self, model_name, precision, load_device="offload_device", quantization="disabled", compile=False):
        
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
@@ -787,19 +879,34 @@ class LoadWanVideoT5TextEncoder:
 
         tokenizer_path = os.path.join(script_directory, "configs", "T5_tokenizer")
 
-        dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
+        dtype = _DTYPE_MAP[precision]
 
         model_path = folder_paths.get_full_path("text_encoders", model_name)
-        sd = load_torch_file(model_path, safe_load=True)
-
-        T5_text_encoder = T5EncoderModel(
-            text_len=512,
-            dtype=dtype,
-            device=text_encoder_load_device,
-            state_dict=sd,
-            tokenizer_path=tokenizer_path,
-            quantization=quantization
-        )
+
+        def build():
+            # tensors are read one at a time straight onto the load device while the parameters are assigned
+            sd = load_state_dict_lazy(model_path, text_encoder_load_device)
+
+            T5_text_encoder = T5EncoderModel(
+                text_len=512,
+                dtype=dtype,
+                device=text_encoder_load_device,
+                state_dict=sd,
+                tokenizer_path=tokenizer_path,
+                quantization=quantization
+            )
+            if quantization == "torchao_int8":
+                try:
+                    from torchao.quantization import quantize_, int8_weight_only
+                except:
+                    raise ImportError("torchao is not installed")
+                quantize_(T5_text_encoder.model, int8_weight_only())
+            if compile and quantization == "disabled":
+                for block in T5_text_encoder.model.blocks:
+                    _compile_block_forward(block, {"inline_inbuilt_nn_modules": True}, dynamic=True)
+            return T5_text_encoder
+
+        T5_text_encoder = _cached_load(("t5", model_path, os.path.getmtime(model_path), dtype, str(text_encoder_load_device), quantization, compile), build)
         text_encoder = {
             "model": T5_text_encoder,
             "dtype": dtype,
@@ -835,17 +942,24 @@ class LoadWanVideoClipTextEncoder:
 
         text_encoder_load_device = device if load_device == "main_device" else offload_device
 
-        dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
+        dtype = _DTYPE_MAP[precision]
 
         model_path = folder_paths.get_full_path("text_encoders", model_name)
-        sd = load_torch_file(model_path, safe_load=True)
-        clip_model = CLIPModel(dtype=dtype, device=device, state_dict=sd)
-        clip_model.model.to(text_encoder_load_device)
-        del sd
+
+        def build():
+            sd = load_state_dict_lazy(model_path, device)
+            clip_model = CLIPModel(dtype=dtype, device=device, state_dict=sd)
+            clip_model.model.to(text_encoder_load_device)
+            del sd
+            return clip_model
+
+        clip_model = _cached_load(("clip", model_path, os.path.getmtime(model_path), dtype, str(text_encoder_load_device)), build)
         
         return (clip_model,)
     
 
+_PROMPT_SPLIT_RE = re.compile(r"\s*\|\s*")
+
 class WanVideoTextEncode:
     @classmethod
     def INPUT_TYPES(s):
@@ -880,17 +994,15 @@ class WanVideoTextEncode:
         dtype = t5["dtype"]
 
         # Split positive prompts and process each
-        positive_prompts = [p.strip() for p in positive_prompt.split('|')]
+        positive_prompts = _PROMPT_SPLIT_RE.split(positive_prompt.strip())
 
         encoder.model.to(device)
        
         with torch.autocast(device_type=mm.get_autocast_device(device), dtype=dtype, enabled=True):
-            context = encoder(positive_prompts, device)
-            context_null = encoder([negative_prompt], device)
-
+            # one forward for both, the tokenizer pads every prompt to the same text_len
+            embeds = encoder(positive_prompts + [negative_prompt], device)
+            context, context_null = embeds[:len(positive_prompts)], embeds[len(positive_prompts):]
 
-        context = [t.to(device) for t in context]
-        context_null = [t.to(device) for t in context_null]
 
         if force_offload:
             encoder.model.to(offload_device)
@@ -927,6 +1039,12 @@ class WanVideoTextEmbedBridge:
         return (prompt_embeds_dict,)
     
 #region clip image encode
+# compiled once per encoder class, the shared VAE keeps its eager encoder and the compiled forward
+# is only bound to it for the duration of an image encode that asks for it
+@functools.lru_cache(maxsize=None)
+def _compiled_encoder_forward(forward):
+    return torch.compile(forward, dynamic=False)
+
 class WanVideoImageClipEncode:
     @classmethod
     def INPUT_TYPES(s):
@@ -944,7 +1062,8 @@ class WanVideoImageClipEncode:
                 "latent_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.001, "tooltip": "Additional latent multiplier, helpful for I2V where lower values allow for more motion"}),
                 "clip_embed_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.001, "tooltip": "Additional clip embed multiplier"}),
                 "adjust_resolution": ("BOOLEAN", {"default": True, "tooltip": "Performs the same resolution adjustment as in the original code"}),
-
+                "compile_vae_encode": ("BOOLEAN", {"default": False, "tooltip": "torch.compile the VAE encoder, the first run compiles which takes a while, later runs with the same resolution are faster. Requires Triton"}),
+                "keep_vae_loaded": ("BOOLEAN", {"default": False, "tooltip": "Keeps the VAE on the main device after encoding instead of offloading it, avoids moving it back and forth when encoding repeatedly"}),
             }
         }
 
@@ -954,7 +1073,9 @@ class WanVideoImageClipEncode:
     CATEGORY = "WanVideoWrapper"
 
     def process(self, clip_vision, vae, image, num_frames, generation_width, generation_height, force_offload=True, noise_aug_strength=0.0, 
-                latent_strength=1.0, clip_embed_strength=1.0, adjust_resolution=True):
+                latent_strength=1.0, clip_embed_strength=1.0, adjust_resolution=True, compile_vae_encode=False, keep_vae_loaded=False):
+        if (num_frames - 1) % 4 != 0:
+            raise ValueError(f"num_frames must be of the form 4 * n + 1 (e.g. 77, 81, 85), got {num_frames}")
 
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
@@ -973,7 +1094,8 @@ class WanVideoImageClipEncode:
         if isinstance(clip_vision, ClipVisionModel):
             clip_context = clip_vision.encode_image(image).last_hidden_state.to(device)
         else:
-            pixel_values = clip_preprocess(image.to(device), size=224, mean=self.image_mean, std=self.image_std, crop=True).float()
+            # normalized in fp32 by clip_preprocess, the ViT then takes it in its own dtype
+            pixel_values = clip_preprocess(image.to(device), size=224, mean=self.image_mean, std=self.image_std, crop=True).to(clip_vision.dtype)
             clip_context = clip_vision.visual(pixel_values)
         if clip_embed_strength != 1.0:
             clip_context *= clip_embed_strength
@@ -983,13 +1105,10 @@ class WanVideoImageClipEncode:
             mm.soft_empty_cache()
 
         if adjust_resolution:
-            aspect_ratio = H / W
-            lat_h = round(
-            np.sqrt(max_area * aspect_ratio) // vae_stride[1] //
-            patch_size[1] * patch_size[1])
-            lat_w = round(
-                np.sqrt(max_area / aspect_ratio) // vae_stride[2] //
-                patch_size[2] * patch_size[2])
+            # integer sqrt instead of np.sqrt on the float aspect ratio, the float version can round differently when
+            # max_area * H / W is close to a perfect square, so results can differ by one step there
+            lat_h = math.isqrt(max_area * H // W) // vae_stride[1] // patch_size[1] * patch_size[1]
+            lat_w = math.isqrt(max_area * W // H) // vae_stride[2] // patch_size[2] * patch_size[2]
             h = lat_h * vae_stride[1]
             w = lat_w * vae_stride[2]
         else:
@@ -998,19 +1117,10 @@ class WanVideoImageClipEncode:
             lat_h = h // 8
             lat_w = w // 8
 
-        # Step 1: Create initial mask with ones for first frame, zeros for others
-        mask = torch.ones(1, num_frames, lat_h, lat_w, device=device)
-        mask[:, 1:] = 0
-
-        # Step 2: Repeat first frame 4 times and concatenate with remaining frames
-        first_frame_repeated = torch.repeat_interleave(mask[:, 0:1], repeats=4, dim=1)
-        mask = torch.concat([first_frame_repeated, mask[:, 1:]], dim=1)
-
-        # Step 3: Reshape mask into groups of 4 frames
-        mask = mask.view(1, mask.shape[1] // 4, 4, lat_h, lat_w)
-
-        # Step 4: Transpose dimensions and select first batch
-        mask = mask.transpose(1, 2)[0]
+        # Mask with the first frame repeated 4 times, grouped into 4 channels of latent frames:
+        # all channels of the first latent frame are ones, everything else is zeros
+        mask = torch.zeros(4, (num_frames + 3) // 4, lat_h, lat_w, device=device)
+        mask[:, 0] = 1
 
         # Calculate maximum sequence length
         frames_per_stride = (num_frames - 1) // vae_stride[0] + 1
@@ -1022,25 +1132,36 @@ class WanVideoImageClipEncode:
         # Step 1: Resize and rearrange the input image dimensions
         #resized_image = image.permute(0, 3, 1, 2)  # Rearrange dimensions to (B, C, H, W)
         #resized_image = torch.nn.functional.interpolate(resized_image, size=(h, w), mode='bicubic')
-        resized_image = common_upscale(image.movedim(-1, 1), w, h, "lanczos", "disabled")
+        # resized on the device, antialiased bicubic instead of the PIL lanczos round trip on cpu
+        resized_image = torch.nn.functional.interpolate(image.to(device).movedim(-1, 1), size=(h, w), mode="bicubic", antialias=True).clamp_(0, 1)
         resized_image = resized_image.transpose(0, 1)  # Transpose to match required format
-        resized_image = resized_image * 2 - 1
+        resized_image = resized_image.mul_(2).sub_(1)
 
         if noise_aug_strength > 0.0:
             resized_image = add_noise_to_reference_video(resized_image, ratio=noise_aug_strength)
         
-        # Step 2: Create zero padding frames
-        zero_frames = torch.zeros(3, num_frames-1, h, w, device=device)
-
-        # Step 3: Concatenate image with zero frames
-        concatenated = torch.concat([resized_image.to(device), zero_frames, resized_image.to(device)], dim=1).to(device = device, dtype = vae.dtype)
+        # Step 2 and 3: image, zero padding frames, image again, filled into one preallocated tensor in the VAE dtype
+        num_images = resized_image.shape[1]
+        concatenated = torch.empty(3, num_frames - 1 + 2 * num_images, h, w, device=device, dtype=vae.dtype)
+        concatenated[:, :num_images].copy_(resized_image)
+        concatenated[:, num_images:-num_images].zero_()
+        concatenated[:, -num_images:].copy_(concatenated[:, :num_images])
         concatenated *= latent_strength
-        y = vae.encode([concatenated], device)[0]
+        encoder = vae.model.encoder
+        if compile_vae_encode:
+            # the temporal chunk loop stays eager, the per chunk encoder only sees a couple of fixed shapes
+            encoder.forward = functools.partial(_compiled_encoder_forward(type(encoder).forward), encoder)
+        try:
+            y = vae.encode([concatenated], device)[0]
+        finally:
+            if compile_vae_encode:
+                del encoder.forward
 
         y = torch.concat([mask, y])
 
         vae.model.clear_cache()
-        vae.to(offload_device)
+        if not keep_vae_loaded:
+            vae.to(offload_device)
 
         image_embeds = {
             "image_embeds": y,
@@ -1140,7 +1261,7 @@ class WanVideoSLG:
     DESCRIPTION = "Skips uncond on the selected blocks"
 
     def process(self, blocks, start_percent, end_percent):
-        slg_block_list = [int(x.strip()) for x in blocks.split(",")]
+        slg_block_list = frozenset(int(x.strip()) for x in blocks.split(","))
 
         slg_args = {
             "blocks": slg_block_list,
@@ -1234,7 +1355,57 @@ class WanVideoLoopArgs:
 
     def process(self, **kwargs):
         return (kwargs,)
-    
+
+# only depends on the model and frame count, built on the device once so the transformer doesn't upload it every forward
+@functools.lru_cache(maxsize=8)
+def _build_rope_freqs(d, latent_video_length, riflex_freq_index, device):
+    return torch.cat([
+        rope_params(1024, d - 4 * (d // 6), L_test=latent_video_length, k=riflex_freq_index),
+        rope_params(1024, 2 * (d // 6)),
+        rope_params(1024, 2 * (d // 6))
+    ],
+    dim=1).to(device)
+
+# building the sigma tables is pure setup, only the step state has to be fresh per run
+@functools.lru_cache(maxsize=8)
+def _make_scheduler(scheduler, shift, steps, device):
+    if scheduler == 'unipc':
+        sample_scheduler = FlowUniPCMultistepScheduler(
+            num_train_timesteps=1000,
+            shift=shift,
+            use_dynamic_shifting=False)
+        sample_scheduler.set_timesteps(
+            steps, device=device, shift=shift)
+        timesteps = sample_scheduler.timesteps
+    elif scheduler == 'euler':
+        sample_scheduler = FlowMatchEulerDiscreteScheduler(
+            num_train_timesteps=1000,
+            shift=shift,
+            use_dynamic_shifting=False)
+        sampling_sigmas = get_sampling_sigmas(steps, shift)
+        timesteps, _ = retrieve_timesteps(
+            sample_scheduler,
+            device=device,
+            sigmas=sampling_sigmas)
+    elif 'dpm++' in scheduler:
+        if scheduler == 'dpm++_sde':
+            algorithm_type = "sde-dpmsolver++"
+        else:
+            algorithm_type = "dpmsolver++"
+        sample_scheduler = FlowDPMSolverMultistepScheduler(
+            num_train_timesteps=1000,
+            shift=shift,
+            use_dynamic_shifting=False,
+            algorithm_type= algorithm_type)
+        sampling_sigmas = get_sampling_sigmas(steps, shift)
+        timesteps, _ = retrieve_timesteps(
+            sample_scheduler,
+            device=device,
+            sigmas=sampling_sigmas)
+    else:
+        raise NotImplementedError("Unsupported solver.")
+    return sample_scheduler, timesteps
+
 class WanVideoSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -1263,10 +1434,11 @@ class WanVideoSampler:
                 "context_options": ("WANVIDCONTEXT", ),
                 "teacache_args": ("TEACACHEARGS", ),
                 "flowedit_args": ("FLOWEDITARGS", ),
-                "batched_cfg": ("BOOLEAN", {"default": False, "tooltip": "Batc cond and uncond for faster sampling, possibly faster on some hardware, uses more memory"}),
+                "batched_cfg": ("BOOLEAN", {"default": True, "tooltip": "Batch cond and uncond into a single model call for faster sampling, uses more memory. Ignored when using SLG"}),
                 "slg_args": ("SLGARGS", ),
                 "rope_function": (["default", "comfy"], {"default": "default", "tooltip": "!EXPERIMENTAL! Comfy's RoPE implementation doesn't use complex numbers and can thus be compiled, that should be a lot faster when using torch.compile"}),
                 "loop_args": ("LOOPARGS", ),
+                "noise_device": (["gpu", "cpu"], {"default": "gpu", "tooltip": "Device the noise is generated on, generating on gpu avoids the copy, cpu gives the same noise for a seed as before"}),
             }
         }
 
@@ -1277,7 +1449,7 @@ class WanVideoSampler:
 
     def process(self, model, text_embeds, image_embeds, shift, steps, cfg, seed, scheduler, riflex_freq_index, 
         force_offload=True, samples=None, feta_args=None, denoise_strength=1.0, context_options=None, 
-        teacache_args=None, flowedit_args=None, batched_cfg=False, slg_args=None, rope_function="default", loop_args=None):
+        teacache_args=None, flowedit_args=None, batched_cfg=True, slg_args=None, rope_function="default", loop_args=None, noise_device="gpu"):
         #assert not (context_options and teacache_args), "Context options cannot currently be used together with teacache."
         patcher = model
         model = model.model
@@ -1288,47 +1460,19 @@ class WanVideoSampler:
         
         steps = int(steps/denoise_strength)
 
-        if scheduler == 'unipc':
-            sample_scheduler = FlowUniPCMultistepScheduler(
-                num_train_timesteps=1000,
-                shift=shift,
-                use_dynamic_shifting=False)
-            sample_scheduler.set_timesteps(
-                steps, device=device, shift=shift)
-            timesteps = sample_scheduler.timesteps
-        elif scheduler == 'euler':
-            sample_scheduler = FlowMatchEulerDiscreteScheduler(
-                num_train_timesteps=1000,
-                shift=shift,
-                use_dynamic_shifting=False)
-            sampling_sigmas = get_sampling_sigmas(steps, shift)
-            timesteps, _ = retrieve_timesteps(
-                sample_scheduler,
-                device=device,
-                sigmas=sampling_sigmas)
-        elif 'dpm++' in scheduler:
-            if scheduler == 'dpm++_sde':
-                algorithm_type = "sde-dpmsolver++"
-            else:
-                algorithm_type = "dpmsolver++"
-            sample_scheduler = FlowDPMSolverMultistepScheduler(
-                num_train_timesteps=1000,
-                shift=shift,
-                use_dynamic_shifting=False,
-                algorithm_type= algorithm_type)
-            sampling_sigmas = get_sampling_sigmas(steps, shift)
-            timesteps, _ = retrieve_timesteps(
-                sample_scheduler,
-                device=device,
-                sigmas=sampling_sigmas)
-        else:
-            raise NotImplementedError("Unsupported solver.")
+        sample_scheduler, timesteps = _make_scheduler(scheduler, shift, steps, device)
+        # the schedulers keep per-run step state, the cached one is only a template
+        sample_scheduler = copy.deepcopy(sample_scheduler)
+        timesteps = timesteps.clone()
         
         if denoise_strength < 1.0:
             steps = int(steps * denoise_strength)
             timesteps = timesteps[-(steps + 1):] 
+        # the schedule length is fixed from here on, FlowEdit only overwrites entries in place
+        num_steps = len(timesteps)
         
-        seed_g = torch.Generator(device=torch.device("cpu"))
+        noise_device = device if noise_device == "gpu" else torch.device("cpu")
+        seed_g = torch.Generator(device=noise_device)
         seed_g.manual_seed(seed)
         image_cond = None
         clip_fea = None
@@ -1345,7 +1489,7 @@ class WanVideoSampler:
                 lat_w,
                 dtype=torch.float32,
                 generator=seed_g,
-                device=torch.device("cpu"))
+                device=noise_device)
             seq_len = image_embeds["max_seq_len"]
             image_cond = image_embeds.get("image_embeds", None)
             print("image_cond", image_cond.shape)
@@ -1362,7 +1506,7 @@ class WanVideoSampler:
                     target_shape[2],
                     target_shape[3],
                     dtype=torch.float32,
-                    device=torch.device("cpu"),
+                    device=noise_device,
                     generator=seed_g)
             
             control_latents = image_embeds.get("control_images", None)
@@ -1380,21 +1524,24 @@ class WanVideoSampler:
 
         is_looped = False
         if context_options is not None:
+            # the mask only varies along the frame dim, so it's kept as a (1, frames, 1, 1) weight that broadcasts,
+            # and there are only a few variants depending on which sides blend, built once per run
+            window_mask_cache = {}
             def create_window_mask(noise_pred_context, c, latent_video_length, context_overlap, looped=False):
-                window_mask = torch.ones_like(noise_pred_context)
-                
                 # Apply left-side blending for all except first chunk (or always in loop mode)
-                if min(c) > 0 or (looped and max(c) == latent_video_length - 1):
-                    ramp_up = torch.linspace(0, 1, context_overlap, device=noise_pred_context.device)
-                    ramp_up = ramp_up.view(1, -1, 1, 1)
-                    window_mask[:, :context_overlap] = ramp_up
-                    
+                ramp_left = min(c) > 0 or (looped and max(c) == latent_video_length - 1)
                 # Apply right-side blending for all except last chunk (or always in loop mode)
-                if max(c) < latent_video_length - 1 or (looped and min(c) == 0):
-                    ramp_down = torch.linspace(1, 0, context_overlap, device=noise_pred_context.device)
-                    ramp_down = ramp_down.view(1, -1, 1, 1)
-                    window_mask[:, -context_overlap:] = ramp_down
-                    
+                ramp_right = max(c) < latent_video_length - 1 or (looped and min(c) == 0)
+
+                key = (noise_pred_context.shape[1], ramp_left, ramp_right, noise_pred_context.dtype, noise_pred_context.device)
+                window_mask = window_mask_cache.get(key)
+                if window_mask is None:
+                    window_mask = torch.ones(1, noise_pred_context.shape[1], 1, 1, dtype=noise_pred_context.dtype, device=noise_pred_context.device)
+                    if ramp_left:
+                        window_mask[:, :context_overlap] = torch.linspace(0, 1, context_overlap, device=noise_pred_context.device).view(1, -1, 1, 1)
+                    if ramp_right:
+                        window_mask[:, -context_overlap:] = torch.linspace(1, 0, context_overlap, device=noise_pred_context.device).view(1, -1, 1, 1)
+                    window_mask_cache[key] = window_mask
                 return window_mask
             
             context_schedule = context_options["context_schedule"]
@@ -1402,10 +1549,14 @@ class WanVideoSampler:
             context_stride = context_options["context_stride"] // 4
             context_overlap = context_options["context_overlap"] // 4
             context_vae = context_options.get("vae", None)
+            # read once here, the step loop only uses the locals
+            context_verbose = context_options["verbose"]
+            image_cond_window_count = context_options.get("image_cond_window_count", 2)
+            image_cond_start_step = context_options.get("image_cond_start_step", 6)
             if context_vae is not None:
                 context_vae.to(device)
 
-            self.window_tracker = WindowTracker(verbose=context_options["verbose"])
+            self.window_tracker = WindowTracker(verbose=context_verbose)
 
             # Get total number of prompts
             num_prompts = len(text_embeds["prompt_embeds"])
@@ -1413,6 +1564,29 @@ class WanVideoSampler:
             # Calculate which section this context window belongs to
             section_size = latent_video_length / num_prompts
             log.info(f"Section size: {section_size}")
+            # a window always maps to the same prompt, so it's only computed the first time the window is seen
+            window_prompt_index = {}
+            def get_prompt_index(window_id, c):
+                prompt_index = window_prompt_index.get(window_id)
+                if prompt_index is None:
+                    prompt_index = window_prompt_index[window_id] = min(int(max(c) / section_size), num_prompts - 1)
+                return prompt_index
+            # device index per window, so slicing and accumulating a window is one index_select/index_add_
+            window_frame_index = {}
+            def get_frame_index(c):
+                key = tuple(c)
+                frame_index = window_frame_index.get(key)
+                if frame_index is None:
+                    frame_index = window_frame_index[key] = torch.tensor(c, dtype=torch.long, device=device)
+                return frame_index
+            # every window gathers into the same buffers, only reallocated if the window shape changes
+            window_buffers = {}
+            def gather_window(name, x, frame_index):
+                shape = (x.shape[0], len(frame_index)) + tuple(x.shape[2:])
+                buffer = window_buffers.get(name)
+                if buffer is None or buffer.shape != shape or buffer.dtype != x.dtype or buffer.device != x.device:
+                    buffer = window_buffers[name] = torch.empty(shape, dtype=x.dtype, device=x.device)
+                return torch.index_select(x, 1, frame_index.to(x.device), out=buffer)
             is_looped = context_schedule == "uniform_looped"
 
             seq_len = math.ceil((noise.shape[2] * noise.shape[3]) / 4 * context_frames)
@@ -1420,7 +1594,10 @@ class WanVideoSampler:
             if context_options["freenoise"]:
                 log.info("Applying FreeNoise")
                 # code from AnimateDiff-Evolved by Kosinkadink (https://github.com/Kosinkadink/ComfyUI-AnimateDiff-Evolved)
+                # later windows read frames that earlier ones already shuffled, so the copies are composed
+                # into one frame index map on the frame indices and the noise is gathered once at the end
                 delta = context_frames - context_overlap
+                frame_map = torch.arange(latent_video_length, device=noise_device)
                 for start_idx in range(0, latent_video_length-context_frames, delta):
                     place_idx = start_idx + context_frames
                     if place_idx >= latent_video_length:
@@ -1429,17 +1606,30 @@ class WanVideoSampler:
 
                     if end_idx + delta >= latent_video_length:
                         final_delta = latent_video_length - place_idx
-                        list_idx = torch.tensor(list(range(start_idx,start_idx+final_delta)), device=torch.device("cpu"), dtype=torch.long)
-                        list_idx = list_idx[torch.randperm(final_delta, generator=seed_g)]
-                        noise[:, place_idx:place_idx + final_delta, :, :] = noise[:, list_idx, :, :]
+                        list_idx = torch.randperm(final_delta, generator=seed_g, device=noise_device) + start_idx
+                        frame_map[place_idx:place_idx + final_delta] = frame_map[list_idx]
                         break
-                    list_idx = torch.tensor(list(range(start_idx,start_idx+delta)), device=torch.device("cpu"), dtype=torch.long)
-                    list_idx = list_idx[torch.randperm(delta, generator=seed_g)]
-                    noise[:, place_idx:place_idx + delta, :, :] = noise[:, list_idx, :, :]
+                    list_idx = torch.randperm(delta, generator=seed_g, device=noise_device) + start_idx
+                    frame_map[place_idx:place_idx + delta] = frame_map[list_idx]
+                noise = noise.index_select(1, frame_map)
             
             log.info(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
             from .context import get_context_scheduler
             context = get_context_scheduler(context_schedule)
+            # static_standard yields the same windows every step, the uniform schedules shift with the step
+            # but are still shared between the FlowEdit source and target passes of that step,
+            # each window is stored with its persistent id and frame index so the loops don't look them up again
+            context_queue_cache = {}
+            def get_context_queue(step):
+                if context_schedule == "static_standard":
+                    step = 0
+                context_queue = context_queue_cache.get(step)
+                if context_queue is None:
+                    context_queue = context_queue_cache[step] = [
+                        (c, self.window_tracker.get_window_id(c), get_frame_index(c))
+                        for c in context(step, steps, latent_video_length, context_frames, context_stride, context_overlap)
+                    ]
+                return context_queue
 
         if samples is not None and denoise_strength < 1.0:
             latent_timestep = timesteps[:1].to(noise)
@@ -1458,13 +1648,7 @@ class WanVideoSampler:
             transformer.rope_embedder.k = riflex_freq_index
             transformer.rope_embedder.num_frames = latent_video_length
         else:
-            d = transformer.dim // transformer.num_heads
-            freqs = torch.cat([
-                rope_params(1024, d - 4 * (d // 6), L_test=latent_video_length, k=riflex_freq_index),
-                rope_params(1024, 2 * (d // 6)),
-                rope_params(1024, 2 * (d // 6))
-            ],
-            dim=1)
+            freqs = _build_rope_freqs(transformer.dim // transformer.num_heads, latent_video_length, riflex_freq_index, device)
 
         if not isinstance(cfg, list):
             cfg = [cfg] * (steps +1)
@@ -1494,11 +1678,9 @@ class WanVideoSampler:
             )
 
         elif model["auto_cpu_offload"]:
-            for module in transformer.modules():
-                if hasattr(module, "offload"):
-                    module.offload()
-                if hasattr(module, "onload"):
-                    module.onload()
+            for module in model["vram_managed_modules"]:
+                module.offload()
+                module.onload()
         elif model["manual_offloading"]:
             transformer.to(device)
         #feta
@@ -1520,13 +1702,14 @@ class WanVideoSampler:
             transformer.rel_l1_thresh = teacache_args["rel_l1_thresh"]
             transformer.teacache_start_step = teacache_args["start_step"]
             transformer.teacache_cache_device = teacache_args["cache_device"]
-            transformer.teacache_end_step = len(timesteps)-1 if teacache_args["end_step"] == -1 else teacache_args["end_step"]
+            transformer.teacache_end_step = num_steps-1 if teacache_args["end_step"] == -1 else teacache_args["end_step"]
             transformer.teacache_use_coefficients = teacache_args["use_coefficients"]
         else:
             transformer.enable_teacache = False
 
         if slg_args is not None:
-            assert batched_cfg is not None, "Batched cfg is not supported with SLG"
+            # SLG only skips blocks on the uncond pass, which needs its own call
+            batched_cfg = False
             transformer.slg_blocks = slg_args["blocks"]
             transformer.slg_start_percent = slg_args["start_percent"]
             transformer.slg_end_percent = slg_args["end_percent"]
@@ -1574,7 +1757,15 @@ class WanVideoSampler:
                 drift_cfg = [drift_cfg] * (steps +1)
 
             x_init = samples["samples"].clone().squeeze(0).to(device)
-            x_tgt = samples["samples"].squeeze(0).to(device)
+            # owned copy, the update below is in place and the input latents are cached upstream
+            x_tgt = samples["samples"].squeeze(0).to(device=device, dtype=torch.float32, copy=True)
+
+            # cpu noise is drawn into one pinned buffer so the per-step upload is an async copy,
+            # the event keeps the next draw from overwriting it before the copy is done
+            edit_noise_buffer = None
+            if noise_device.type == "cpu" and torch.device(device).type == "cuda":
+                edit_noise_buffer = torch.empty(x_init.shape, dtype=torch.float32, pin_memory=True)
+                edit_noise_copied = None
 
             sample_scheduler = FlowMatchEulerDiscreteScheduler(
                 num_train_timesteps=1000,
@@ -1595,7 +1786,7 @@ class WanVideoSampler:
         def predict_with_cfg(z, cfg_scale, positive_embeds, negative_embeds, timestep, idx, image_cond=None, clip_fea=None, teacache_state=None):
             with torch.autocast(device_type=mm.get_autocast_device(device), dtype=model["dtype"], enabled=True):
                 nonlocal patcher
-                current_step_percentage = idx / len(timesteps)
+                current_step_percentage = idx / num_steps
                 control_enabled = False
                 if control_latents is not None:
                     control_enabled = True
@@ -1643,6 +1834,20 @@ class WanVideoSampler:
                     return noise_pred_uncond + cfg_scale * (noise_pred_cond - noise_pred_uncond), [teacache_state_cond, teacache_state_uncond]
                 #batched
                 else:
+                    # cfg 1 needs no uncond pass, the single sample keeps its own teacache slot
+                    # so it never shares cached residuals with the batched pair in slot 0
+                    if math.isclose(cfg_scale, 1.0):
+                        noise_pred_cond, teacache_state_cond = transformer(
+                            [z], context=[positive_embeds], is_uncond=False, current_step_percentage=current_step_percentage,
+                            pred_id=teacache_state[1] if teacache_state else None,
+                            **base_params
+                        )
+                        return noise_pred_cond[0].to(intermediate_device), [teacache_state[0] if teacache_state else None, teacache_state_cond]
+                    # the image conditioning and clip features have to cover both samples of the batch
+                    if image_cond is not None:
+                        base_params['y'] = [image_cond, image_cond]
+                    if clip_fea is not None:
+                        base_params['clip_fea'] = torch.cat([clip_fea, clip_fea])
                     [noise_pred_cond, noise_pred_uncond], teacache_state_cond = transformer(
                         [z] + [z], context= [positive_embeds] + negative_embeds, is_uncond=False, current_step_percentage=current_step_percentage,
                         pred_id=teacache_state[0] if teacache_state else None,
@@ -1663,13 +1868,11 @@ class WanVideoSampler:
         intermediate_device = device
 
         # diff diff prep
-        masks = None
+        # the per-step masks are thresholded from this one when needed instead of stacking one per step up front
+        diff_mask = None
         if samples is not None and mask is not None:
-            mask = 1 - mask
-            thresholds = torch.arange(len(timesteps), dtype=original_image.dtype) / len(timesteps)
-            thresholds = thresholds.unsqueeze(1).unsqueeze(1).unsqueeze(1).unsqueeze(1).to(device)
-            masks = mask.repeat(len(timesteps), 1, 1, 1, 1).to(device) 
-            masks = masks > thresholds
+            # the encoded latent mask is (1, C, T, H, W), the latents are unbatched
+            diff_mask = (1 - mask)[0].to(device)
 
         latent_shift_loop = False
         if loop_args is not None:
@@ -1679,6 +1882,16 @@ class WanVideoSampler:
             latent_shift_start_percent = loop_args["start_percent"]
             latent_shift_end_percent = loop_args["end_percent"]
             shift_idx = 0
+        # plain euler has no solver state, so the step is done inline from precomputed sigma deltas
+        # instead of going through scheduler.step and its timestep lookup
+        euler_dts = None
+        if scheduler == "euler" and flowedit_args is None:
+            sigma_offset = len(sample_scheduler.timesteps) - num_steps
+            euler_dts = (sample_scheduler.sigmas[1:] - sample_scheduler.sigmas[:-1])[sigma_offset:].tolist()
+
+        # host copy of the sigmas, the step preview is then a single sub with a scalar alpha
+        preview_sigmas = (timesteps / 1000).tolist()
+
         #main loop start
         for idx, t in enumerate(tqdm(timesteps)):    
             if flowedit_args is not None:
@@ -1686,26 +1899,26 @@ class WanVideoSampler:
                     continue
 
             # diff diff
-            if masks is not None:
-                if idx < len(timesteps) - 1:
+            if diff_mask is not None:
+                if idx < num_steps - 1:
                     noise_timestep = timesteps[idx+1]
                     image_latent = sample_scheduler.scale_noise(
                         original_image, torch.tensor([noise_timestep]), noise.to(device)
                     )
-                    mask = masks[idx]
-                    mask = mask.to(latent)
+                    mask = (diff_mask > idx / num_steps).to(latent)
                     latent = image_latent * mask + latent * (1-mask)
                     # end diff diff
 
             latent_model_input = latent.to(device)
 
-            timestep = torch.tensor([t]).to(device)
-            current_step_percentage = idx / len(timesteps)
+            # t is already a 0-dim tensor from timesteps, torch.tensor([t]) would sync it to the host and copy it back
+            timestep = t.reshape(1).to(device)
+            current_step_percentage = idx / num_steps
 
             ### latent shift
             if latent_shift_loop:
                 if latent_shift_start_percent <= current_step_percentage <= latent_shift_end_percent:
-                    latent_model_input = torch.cat([latent_model_input[:, shift_idx:]] + [latent_model_input[:, :shift_idx]], dim=1)
+                    latent_model_input = torch.roll(latent_model_input, shifts=-shift_idx, dims=1)
 
             #enhance-a-video
             if feta_args is not None:
@@ -1716,40 +1929,46 @@ class WanVideoSampler:
             #flow-edit
             if flowedit_args is not None:
                 sigma = t / 1000.0
-                sigma_prev = (timesteps[idx + 1] if idx < len(timesteps) - 1 else timesteps[-1]) / 1000.0
-                noise = torch.randn(x_init.shape, generator=seed_g, device=torch.device("cpu"))
-                if idx < len(timesteps) - drift_steps:
+                sigma_prev = (timesteps[idx + 1] if idx < num_steps - 1 else timesteps[-1]) / 1000.0
+                if edit_noise_buffer is not None:
+                    if edit_noise_copied is not None:
+                        edit_noise_copied.synchronize()
+                    edit_noise_buffer.normal_(generator=seed_g)
+                    noise = edit_noise_buffer.to(device, non_blocking=True)
+                    edit_noise_copied = torch.cuda.Event()
+                    edit_noise_copied.record()
+                else:
+                    noise = torch.randn(x_init.shape, generator=seed_g, device=noise_device)
+                if idx < num_steps - drift_steps:
                     cfg = drift_cfg
                 
                 zt_src = (1-sigma) * x_init + sigma * noise.to(t)
                 zt_tgt = x_tgt + zt_src - x_init
 
                 #source
-                if idx < len(timesteps) - drift_steps:
+                if idx < num_steps - drift_steps:
                     if context_options is not None:
-                        counter = torch.zeros_like(zt_src, device=intermediate_device)
+                        counter = torch.zeros(1, latent_video_length, 1, 1, device=intermediate_device, dtype=zt_src.dtype)
                         vt_src = torch.zeros_like(zt_src, device=intermediate_device)
-                        context_queue = list(context(idx, steps, latent_video_length, context_frames, context_stride, context_overlap))
-                        for c in context_queue:
-                            window_id = self.window_tracker.get_window_id(c)
-
+                        context_queue = get_context_queue(idx)
+                        for c, window_id, frame_index in context_queue:
                             if teacache_args is not None:
                                 current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
                             else:
                                 current_teacache = None
 
-                            prompt_index = min(int(max(c) / section_size), num_prompts - 1)
-                            if context_options["verbose"]:
+                            prompt_index = get_prompt_index(window_id, c)
+                            if context_verbose:
                                 log.info(f"Prompt index: {prompt_index}")
 
                             positive = source_embeds["prompt_embeds"][prompt_index]
 
                             partial_img_emb = None
                             if source_image_cond is not None:
-                                partial_img_emb = source_image_cond[:, c, :, :]
-                                partial_img_emb[:, 0, :, :] = source_image_cond[:, 0, :, :].to(intermediate_device)
+                                partial_img_emb = gather_window("image_cond", source_image_cond, frame_index)
+                                partial_img_emb[:, 0, :, :] = source_image_cond[:, 0, :, :]
 
-                            partial_zt_src = zt_src[:, c, :, :]
+                            partial_zt_src = gather_window("latent", zt_src, frame_index)
                             vt_src_context, new_teacache = predict_with_cfg(
                                 partial_zt_src, cfg[idx], 
                                 positive, source_embeds["negative_prompt_embeds"],
@@ -1760,9 +1979,9 @@ class WanVideoSampler:
                                 self.window_tracker.teacache_states[window_id] = new_teacache
 
                             window_mask = create_window_mask(vt_src_context, c, latent_video_length, context_overlap)
-                            vt_src[:, c, :, :] += vt_src_context * window_mask
-                            counter[:, c, :, :] += window_mask
-                        vt_src /= counter
+                            vt_src.index_add_(1, frame_index, vt_src_context * window_mask)
+                            counter.index_add_(1, frame_index, window_mask)
+                        vt_src.div_(counter)
                     else:
                         vt_src, self.teacache_state_source = predict_with_cfg(
                             zt_src, cfg[idx], 
@@ -1772,35 +1991,33 @@ class WanVideoSampler:
                             source_clip_fea,
                             teacache_state=self.teacache_state_source)
                 else:
-                    if idx == len(timesteps) - drift_steps:
+                    if idx == num_steps - drift_steps:
                         x_tgt = zt_tgt
                     zt_tgt = x_tgt
                     vt_src = 0
                 #target
                 if context_options is not None:
-                    counter = torch.zeros_like(zt_tgt, device=intermediate_device)
+                    counter = torch.zeros(1, latent_video_length, 1, 1, device=intermediate_device, dtype=zt_tgt.dtype)
                     vt_tgt = torch.zeros_like(zt_tgt, device=intermediate_device)
-                    context_queue = list(context(idx, steps, latent_video_length, context_frames, context_stride, context_overlap))
-                    for c in context_queue:
-                        window_id = self.window_tracker.get_window_id(c)
-
+                    context_queue = get_context_queue(idx)
+                    for c, window_id, frame_index in context_queue:
                         if teacache_args is not None:
                             current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
                         else:
                             current_teacache = None
 
-                        prompt_index = min(int(max(c) / section_size), num_prompts - 1)
-                        if context_options["verbose"]:
+                        prompt_index = get_prompt_index(window_id, c)
+                        if context_verbose:
                             log.info(f"Prompt index: {prompt_index}")
                      
                         positive = text_embeds["prompt_embeds"][prompt_index]
                         
                         partial_img_emb = None
                         if image_cond is not None:
-                            partial_img_emb = image_cond[:, c, :, :]
-                            partial_img_emb[:, 0, :, :] = image_cond[:, 0, :, :].to(intermediate_device)
+                            partial_img_emb = gather_window("image_cond", image_cond, frame_index)
+                            partial_img_emb[:, 0, :, :] = image_cond[:, 0, :, :]
 
-                        partial_zt_tgt = zt_tgt[:, c, :, :]
+                        partial_zt_tgt = gather_window("latent", zt_tgt, frame_index)
                         vt_tgt_context, new_teacache = predict_with_cfg(
                             partial_zt_tgt, cfg[idx], 
                             positive, text_embeds["negative_prompt_embeds"],
@@ -1811,9 +2028,9 @@ class WanVideoSampler:
                             self.window_tracker.teacache_states[window_id] = new_teacache
                         
                         window_mask = create_window_mask(vt_tgt_context, c, latent_video_length, context_overlap)
-                        vt_tgt[:, c, :, :] += vt_tgt_context * window_mask
-                        counter[:, c, :, :] += window_mask
-                    vt_tgt /= counter
+                        vt_tgt.index_add_(1, frame_index, vt_tgt_context * window_mask)
+                        counter.index_add_(1, frame_index, window_mask)
+                    vt_tgt.div_(counter)
                 else:
                     vt_tgt, self.teacache_state = predict_with_cfg(
                         zt_tgt, cfg[idx], 
@@ -1822,26 +2039,23 @@ class WanVideoSampler:
                         timestep, idx, image_cond, clip_fea,
                         teacache_state=self.teacache_state)
                 v_delta = vt_tgt - vt_src
-                x_tgt = x_tgt.to(torch.float32)
-                v_delta = v_delta.to(torch.float32)
-                x_tgt = x_tgt + (sigma_prev - sigma) * v_delta
+                # x_tgt is kept in fp32 for the whole edit, the step is applied in place
+                x_tgt.addcmul_(v_delta.to(torch.float32), sigma_prev - sigma)
                 x0 = x_tgt
             #context windowing
             elif context_options is not None:
-                counter = torch.zeros_like(latent_model_input, device=intermediate_device)
+                counter = torch.zeros(1, latent_video_length, 1, 1, device=intermediate_device, dtype=latent_model_input.dtype)
                 noise_pred = torch.zeros_like(latent_model_input, device=intermediate_device)
-                context_queue = list(context(idx, steps, latent_video_length, context_frames, context_stride, context_overlap))
+                context_queue = get_context_queue(idx)
                 
-                for c in context_queue:
-                    window_id = self.window_tracker.get_window_id(c)
-                    
+                for c, window_id, frame_index in context_queue:
                     if teacache_args is not None:
                         current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
                     else:
                         current_teacache = None
 
-                    prompt_index = min(int(max(c) / section_size), num_prompts - 1)
-                    if context_options["verbose"]:
+                    prompt_index = get_prompt_index(window_id, c)
+                    if context_verbose:
                         log.info(f"Prompt index: {prompt_index}")
                     
                     # Use the appropriate prompt for this section
@@ -1850,14 +2064,14 @@ class WanVideoSampler:
                     partial_img_emb = None
                     if image_cond is not None:
                         log.info(f"Image cond shape: {image_cond.shape}")
-                        num_windows= context_options["image_cond_window_count"]
-                        section_size = latent_video_length / num_windows
-                        image_index = min(int(max(c) / section_size), num_windows - 1)
-                        partial_img_emb = image_cond[:, c, :, :]
+                        num_windows = image_cond_window_count
+                        image_section_size = latent_video_length / num_windows
+                        image_index = min(int(max(c) / image_section_size), num_windows - 1)
+                        partial_img_emb = gather_window("image_cond", image_cond, frame_index)
                         partial_image_cond = image_cond[:, 0, :, :].to(intermediate_device)
                         log.info(f"image_index: {image_index}")
                         if hasattr(self, "previous_noise_pred_context") and image_index > 0: #wip
-                            if idx >= context_options["image_cond_start_step"]:
+                            if idx >= image_cond_start_step:
                                 #strength = 0.5
                                 #partial_image_cond *= strength
                                 mask = torch.ones(4, partial_img_emb.shape[2], partial_img_emb.shape[3], device=partial_img_emb.device, dtype=partial_img_emb.dtype) #torch.Size([20, 10, 104, 60])
@@ -1882,7 +2096,7 @@ class WanVideoSampler:
                             else:
                                 partial_img_emb[:, 0, :, :] =  partial_image_cond
                       
-                    partial_latent_model_input = latent_model_input[:, c, :, :]
+                    partial_latent_model_input = gather_window("latent", latent_model_input, frame_index)
 
                     noise_pred_context, new_teacache = predict_with_cfg(
                         partial_latent_model_input, 
@@ -1901,9 +2115,9 @@ class WanVideoSampler:
                         self.previous_noise_pred_context = noise_pred_context
 
                     window_mask = create_window_mask(noise_pred_context, c, latent_video_length, context_overlap, looped=is_looped)                    
-                    noise_pred[:, c, :, :] += noise_pred_context * window_mask
-                    counter[:, c, :, :] += window_mask
-                noise_pred /= counter
+                    noise_pred.index_add_(1, frame_index, noise_pred_context * window_mask)
+                    counter.index_add_(1, frame_index, window_mask)
+                noise_pred.div_(counter)
             #normal inference
             else:
                 noise_pred, self.teacache_state = predict_with_cfg(
@@ -1917,31 +2131,35 @@ class WanVideoSampler:
             if latent_shift_loop:
                 #reverse latent shift
                 if latent_shift_start_percent <= current_step_percentage <= latent_shift_end_percent:
-                    noise_pred = torch.cat([noise_pred[:, latent_video_length - shift_idx:]] + [noise_pred[:, :latent_video_length - shift_idx]], dim=1)
+                    noise_pred = torch.roll(noise_pred, shifts=shift_idx, dims=1)
                     shift_idx = (shift_idx + latent_skip) % latent_video_length
                 
             
             if flowedit_args is None:
                 latent = latent.to(intermediate_device)
                 
-                temp_x0 = sample_scheduler.step(
-                    noise_pred.unsqueeze(0),
-                    t,
-                    latent.unsqueeze(0),
-                    return_dict=False,
-                    generator=seed_g)[0]
-                latent = temp_x0.squeeze(0)
+                if euler_dts is not None:
+                    # not in place, latent_model_input still aliases latent for the preview
+                    latent = torch.add(latent, noise_pred, alpha=euler_dts[idx])
+                else:
+                    temp_x0 = sample_scheduler.step(
+                        noise_pred.unsqueeze(0),
+                        t,
+                        latent.unsqueeze(0),
+                        return_dict=False,
+                        generator=seed_g)[0]
+                    latent = temp_x0.squeeze(0)
 
                 x0 = latent.to(device)
                 if callback is not None:
-                    callback_latent = (latent_model_input - noise_pred.to(t.device) * t / 1000).detach().permute(1,0,2,3)
+                    callback_latent = torch.sub(latent_model_input, noise_pred, alpha=preview_sigmas[idx]).permute(1,0,2,3)
                     callback(idx, callback_latent, None, steps)
                 else:
                     pbar.update(1)
                 del latent_model_input, timestep
             else:
                 if callback is not None:
-                    callback_latent = (zt_tgt - vt_tgt.to(t.device) * t / 1000).detach().permute(1,0,2,3)
+                    callback_latent = torch.sub(zt_tgt, vt_tgt, alpha=preview_sigmas[idx]).permute(1,0,2,3)
                     callback(idx, callback_latent, None, steps)
                 else:
                     pbar.update(1)
@@ -1967,7 +2185,6 @@ class WanVideoSampler:
             if model["manual_offloading"]:
                 transformer.to(offload_device)
                 mm.soft_empty_cache()
-                gc.collect()
 
         try:
             print_memory(device)
@@ -2025,36 +2242,37 @@ class WanVideoDecode:
     def decode(self, vae, samples, enable_vae_tiling, tile_x, tile_y, tile_stride_x, tile_stride_y):
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
-        mm.soft_empty_cache()
         latents = samples["samples"]
         vae.to(device)
 
-        latents = latents.to(device = device, dtype = vae.dtype)
-
-        mm.soft_empty_cache()
-
         is_looped = samples.get("looped", False)
         warmup_latent_count = 3
 
+        latents = latents.to(dtype = vae.dtype)
         if is_looped:
             latents = torch.cat([latents, latents[:, :, :warmup_latent_count]], dim=2)
 
         if isinstance(vae, TAEHV):            
-            image = vae.decode_video(latents.permute(0, 2, 1, 3, 4))[0].permute(1, 0, 2, 3)
+            image = vae.decode_video(latents.to(device).permute(0, 2, 1, 3, 4))[0].permute(1, 0, 2, 3)
         else:
-            image = vae.decode(latents, device=device, tiled=enable_vae_tiling, tile_size=(tile_x, tile_y), tile_stride=(tile_stride_x, tile_stride_y))[0]
+            # decode keeps the latents on the cpu and moves each chunk or tile to the device itself
+            # tiled_decode splits the latents, so the pixel tile sizes are converted to latent units
+            image = vae.decode(latents, device=device, tiled=enable_vae_tiling, tile_size=(tile_x // 8, tile_y // 8), tile_stride=(tile_stride_x // 8, tile_stride_y // 8))[0]
             vae.model.clear_cache()
-            image = (image - image.min()) / (image.max() - image.min())
+            image_min, image_max = torch.aminmax(image)
+            image.sub_(image_min).div_((image_max - image_min).clamp_min(1e-8))
         vae.to(offload_device)
 
         if is_looped:
             image = image[:, warmup_latent_count * 4:]
         
+        # once, after the VAE is offloaded, the caching allocator reuses freed blocks within the decode itself
         mm.soft_empty_cache()
 
         
-        image = torch.clamp(image, 0.0, 1.0)
-        image = image.permute(1, 2, 3, 0).cpu().float()
+        # clamp, reorder and upcast on the device in one copy so the download is a single contiguous fp32 transfer
+        image = image.clamp_(0.0, 1.0).permute(1, 2, 3, 0)
+        image = torch.empty(image.shape, dtype=torch.float32, device=image.device).copy_(image).cpu()
 
         return (image,)
 
@@ -2089,20 +2307,24 @@ class WanVideoEncode:
 
         vae.to(device)
 
-        image = (image.clone()).to(vae.dtype).to(device).unsqueeze(0).permute(0, 4, 1, 2, 3) # B, C, T, H, W
+        # one copy on the image's own device that also lays the permuted frames out contiguously,
+        # copy=True keeps it a copy when the dtype already matches since the noise is added in place
+        image = image.unsqueeze(0).permute(0, 4, 1, 2, 3).to(dtype=vae.dtype, memory_format=torch.contiguous_format, copy=True) # B, C, T, H, W
         if noise_aug_strength > 0.0:
             image = add_noise_to_reference_video(image, ratio=noise_aug_strength)
 
         if isinstance(vae, TAEHV):
-            latents = vae.encode_video(image.permute(0, 2, 1, 3, 4), parallel=False)# B, T, C, H, W
+            latents = vae.encode_video(image.to(device).permute(0, 2, 1, 3, 4), parallel=False)# B, T, C, H, W
             latents = latents.permute(0, 2, 1, 3, 4)
         else:
+            # encode keeps the frames on the cpu and moves each chunk or tile to the device itself
             latents = vae.encode(image * 2.0 - 1.0, device=device, tiled=enable_vae_tiling, tile_size=(tile_x, tile_y), tile_stride=(tile_stride_x, tile_stride_y))
             vae.model.clear_cache()
         if latent_strength != 1.0:
             latents *= latent_strength
 
         log.info(f"encoded latents shape {latents.shape}")
+        out = {"samples": latents}
 
         if mask is None:
             vae.to(offload_device)
@@ -2113,19 +2335,44 @@ class WanVideoEncode:
             target_h, target_w = latents.shape[3:]
 
             mask = torch.nn.functional.interpolate(
-                mask.unsqueeze(0).unsqueeze(0),  # Add batch and channel dims [1,1,T,H,W]
+                mask.to(device).unsqueeze(0).unsqueeze(0),  # Add batch and channel dims [1,1,T,H,W]
                 size=(latents.shape[2], target_h, target_w),
                 mode='trilinear',
                 align_corners=False
             ).squeeze(0)  # Remove batch dim, keep channel dim
             
             # Add batch & channel dims for final output
-            latent_mask = mask.unsqueeze(0).repeat(1, latents.shape[1], 1, 1, 1)
+            # same mask for every channel, the sampler only reads it
+            latent_mask = mask.unsqueeze(0).expand(1, latents.shape[1], -1, -1, -1)
             log.info(f"latent mask shape {latent_mask.shape}")
+            out["mask"] = latent_mask
             vae.to(offload_device)
         mm.soft_empty_cache()
  
-        return ({"samples": latents, "mask": latent_mask},)
+        return (out,)
+
+_LATENT_RGB_FACTORS = [
+    [0.000159, -0.000223, 0.001299],
+    [0.000566, 0.000786, 0.001948],
+    [0.001531, -0.000337, 0.000863],
+    [0.001887, 0.002190, 0.002117],
+    [0.002032, 0.000782, -0.000512],
+    [0.001634, 0.001260, 0.001685],
+    [0.001360, -0.000292, 0.000189],
+    [0.001410, 0.000769, 0.001935],
+    [-0.000365, 0.000211, 0.000397],
+    [-0.000091, 0.001333, 0.001812],
+    [0.000201, 0.001866, 0.000546],
+    [0.001889, 0.000544, -0.000237],
+    [0.001779, 0.000022, 0.001764],
+    [0.001456, 0.000431, 0.001574],
+    [0.001791, 0.001738, -0.000121],
+    [-0.000034, -0.000405, 0.000708]
+]
+_LATENT_RGB_FACTORS_BIAS = [-0.0011, 0.0, -0.0002]
+# the preview only casts these to the latents' device and dtype
+_LATENT_RGB_FACTORS_TENSOR = torch.tensor(_LATENT_RGB_FACTORS).transpose(0, 1).contiguous()
+_LATENT_RGB_FACTORS_BIAS_TENSOR = torch.tensor(_LATENT_RGB_FACTORS_BIAS)
 
 class WanVideoLatentPreview:
     @classmethod
@@ -2150,59 +2397,33 @@ class WanVideoLatentPreview:
     def sample(self, samples, seed, min_val, max_val, r_bias, g_bias, b_bias):
         mm.soft_empty_cache()
 
-        latents = samples["samples"].clone()
-        print("in sample", latents.shape)
+        latents = samples["samples"]
+        log.debug(f"in sample {latents.shape}")
         #latent_rgb_factors =[[-0.02531045419704009, -0.00504800612542497, 0.13293717293982546], [-0.03421835830845858, 0.13996708548892614, -0.07081038680118075], [0.011091819063647063, -0.03372949685846012, -0.0698232210116172], [-0.06276524604742019, -0.09322986677909442, 0.01826383612148913], [0.021290659938126788, -0.07719530444034409, -0.08247812477766273], [0.04401102991215147, -0.0026401932105894754, -0.01410913586718443], [0.08979717602613707, 0.05361221258740831, 0.11501425309699129], [0.04695121980405198, -0.13053491609675175, 0.05025986885867986], [-0.09704684176098193, 0.03397687417738002, -0.1105886644677771], [0.14694697234804935, -0.12316902186157716, 0.04210404546699645], [0.14432470831243552, -0.002580008133591355, -0.08490676947390643], [0.051502750076553944, -0.10071695490292451, -0.01786223610178095], [-0.12503276881774464, 0.08877830923879379, 0.1076584501927316], [-0.020191205513213406, -0.1493425056303128, -0.14289740371758308], [-0.06470138952271293, -0.07410426095060325, 0.00980804676890873], [0.11747671720735695, 0.10916082743849789, -0.12235599365235904]]
-        latent_rgb_factors = [
-        [0.000159, -0.000223, 0.001299],
-        [0.000566, 0.000786, 0.001948],
-        [0.001531, -0.000337, 0.000863],
-        [0.001887, 0.002190, 0.002117],
-        [0.002032, 0.000782, -0.000512],
-        [0.001634, 0.001260, 0.001685],
-        [0.001360, -0.000292, 0.000189],
-        [0.001410, 0.000769, 0.001935],
-        [-0.000365, 0.000211, 0.000397],
-        [-0.000091, 0.001333, 0.001812],
-        [0.000201, 0.001866, 0.000546],
-        [0.001889, 0.000544, -0.000237],
-        [0.001779, 0.000022, 0.001764],
-        [0.001456, 0.000431, 0.001574],
-        [0.001791, 0.001738, -0.000121],
-        [-0.000034, -0.000405, 0.000708]
-    ]
+        latent_rgb_factors = _LATENT_RGB_FACTORS
 
         import random
         random.seed(seed)
         #latent_rgb_factors = [[random.uniform(min_val, max_val) for _ in range(3)] for _ in range(16)]
         #latent_rgb_factors = [[0.1 for _ in range(3)] for _ in range(16)]
         out_factors = latent_rgb_factors
-        print(latent_rgb_factors)
 
-        latent_rgb_factors_bias = [-0.0011, 0.0, -0.0002]
         #latent_rgb_factors_bias = [r_bias, g_bias, b_bias]
 
-        latent_rgb_factors = torch.tensor(latent_rgb_factors, device=latents.device, dtype=latents.dtype).transpose(0, 1)
-        latent_rgb_factors_bias = torch.tensor(latent_rgb_factors_bias, device=latents.device, dtype=latents.dtype)
-        print(latent_rgb_factors)
+        latent_rgb_factors = _LATENT_RGB_FACTORS_TENSOR.to(device=latents.device, dtype=latents.dtype)
+        latent_rgb_factors_bias = _LATENT_RGB_FACTORS_BIAS_TENSOR.to(device=latents.device, dtype=latents.dtype)
 
-        print("latent_rgb_factors", latent_rgb_factors.shape)
+        log.debug(f"latent_rgb_factors {latent_rgb_factors.shape}")
 
-        latent_images = []
-        for t in range(latents.shape[2]):
-            latent = latents[:, :, t, :, :]
-            latent = latent[0].permute(1, 2, 0)
-            latent_image = torch.nn.functional.linear(
-                latent,
-                latent_rgb_factors,
-                bias=latent_rgb_factors_bias
-            )
-            latent_images.append(latent_image)
-        latent_images = torch.stack(latent_images, dim=0)
-        print("latent_images", latent_images.shape)
-        latent_images_min = latent_images.min()
-        latent_images_max = latent_images.max()
-        latent_images = (latent_images - latent_images_min) / (latent_images_max - latent_images_min)
+        # all frames at once, (C, T, H, W) -> (T, H, W, C) -> (T, H, W, 3)
+        latent_images = torch.nn.functional.linear(
+            latents[0].permute(1, 2, 3, 0),
+            latent_rgb_factors,
+            bias=latent_rgb_factors_bias
+        )
+        log.debug(f"latent_images {latent_images.shape}")
+        latent_images_min, latent_images_max = torch.aminmax(latent_images)
+        latent_images.sub_(latent_images_min).div_((latent_images_max - latent_images_min).clamp_min(1e-8))
 
         return (latent_images.float().cpu(), out_factors)
 
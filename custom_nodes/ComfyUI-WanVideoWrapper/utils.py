@@ -1,4 +1,5 @@
 import importlib.metadata
+import re
 import torch
 import logging
 from tqdm import tqdm
@@ -25,6 +26,83 @@ def print_memory(device):
     #memory_summary = torch.cuda.memory_summary(device=device, abbreviated=False)
     #log.info(f"Memory Summary:\n{memory_summary}")
 
+class LazySafetensorsDict:
+    """
+    Read-only dict view of a safetensors file, tensors are only read when accessed
+    and are created directly on the device the file was opened for.
+    """
+    def __init__(self, path, device):
+        from safetensors import safe_open
+        self.handle = safe_open(path, framework="pt", device=str(device))
+        self.key_map = {k: k for k in self.handle.keys()}
+
+    def __getitem__(self, key):
+        return self.handle.get_tensor(self.key_map[key])
+
+    def __contains__(self, key):
+        return key in self.key_map
+
+    def __iter__(self):
+        return iter(self.key_map)
+
+    def __len__(self):
+        return len(self.key_map)
+
+    def __delitem__(self, key):
+        del self.key_map[key]
+
+    def keys(self):
+        return self.key_map.keys()
+
+    def items(self):
+        for key in self.key_map:
+            yield key, self[key]
+
+    def pop(self, key, *default):
+        if key not in self.key_map and default:
+            return default[0]
+        value = self[key]
+        del self.key_map[key]
+        return value
+
+    def rename_keys(self, fn):
+        self.key_map = {fn(k): v for k, v in self.key_map.items()}
+
+    def filter_keys(self, fn):
+        self.key_map = {k: v for k, v in self.key_map.items() if fn(k)}
+
+    def strip_key_prefix(self, prefix):
+        n = len(prefix)
+        self.rename_keys(lambda k: k[n:] if k.startswith(prefix) else k)
+
+def load_state_dict_lazy(path, device):
+    if path.lower().endswith((".safetensors", ".sft")):
+        return LazySafetensorsDict(path, device)
+    from comfy.utils import load_torch_file
+    return load_torch_file(path, device=device, safe_load=True)
+
+def strip_key_prefix(sd, prefix):
+    if isinstance(sd, LazySafetensorsDict):
+        sd.strip_key_prefix(prefix)
+        return sd
+    # renamed in place, so only one dict's hashtable is alive during the rename
+    n = len(prefix)
+    for key in [k for k in sd if k.startswith(prefix)]:
+        sd[key[n:]] = sd.pop(key)
+    return sd
+
+def assign_module_tensor(module, name, value, device, dtype):
+    # tensors that are already in place are wrapped as-is instead of going through another cast and copy
+    device = torch.device(device)
+    if value.dtype == dtype and value.device == device:
+        module_name, _, leaf = name.rpartition(".")
+        submodule = module.get_submodule(module_name)
+        if leaf in submodule._parameters:
+            submodule._parameters[leaf] = torch.nn.Parameter(value, requires_grad=False)
+            return
+    value = value.to(device, dtype=dtype, non_blocking=True)
+    set_module_tensor_to_device(module, name, device=device, dtype=dtype, value=value)
+
 def get_module_memory_mb(module):
     memory = 0
     for param in module.parameters():
@@ -47,6 +125,7 @@ def apply_lora(model, device_to, transformer_load_device, params_to_keep=None, d
                 to_load.append((n, m, params))
 
         to_load.sort(reverse=True)
+        keep_re = re.compile("|".join(map(re.escape, params_to_keep))) if low_mem_load else None
         for x in tqdm(to_load, desc="Loading model and applying LoRA weights:", leave=True):
             name = x[0]
             m = x[1]
@@ -56,7 +135,7 @@ def apply_lora(model, device_to, transformer_load_device, params_to_keep=None, d
                     continue
             for param in params:
                 if low_mem_load:
-                    dtype_to_use = base_dtype if any(keyword in name for keyword in params_to_keep) else dtype
+                    dtype_to_use = base_dtype if keep_re.search(name) else dtype
                     if name.startswith("diffusion_model."):
                         name_no_prefix = name[len("diffusion_model."):]
                     key = "{}.{}".format(name_no_prefix, param)
@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import math
+import itertools
 
 import torch
 import torch.nn as nn
@@ -63,6 +64,14 @@ def poly1d(coefficients, x):
         result += coeff * (x ** (len(coefficients) - 1 - i))
     return result.abs()
 
+@torch.jit.script
+def teacache_poly(x: torch.Tensor, coefficients: torch.Tensor) -> torch.Tensor:
+    # Horner form, coefficients ordered highest degree first like np.poly1d
+    y = coefficients[0]
+    for i in range(1, coefficients.shape[0]):
+        y = y * x + coefficients[i]
+    return y
+
 def sinusoidal_embedding_1d(dim, position):
     # preprocess
     assert dim % 2 == 0
@@ -595,6 +604,7 @@ class WanModel(ModelMixin, ConfigMixin):
         self.teacache_cache_device = offload_device
         self.teacache_state = TeaCacheState(cache_device=self.teacache_cache_device)
         self.teacache_coefficients = teacache_coefficients
+        self.teacache_coeffs = torch.tensor(teacache_coefficients, dtype=torch.float32)
         self.teacache_use_coefficients = False
 
         self.slg_blocks = None
@@ -602,6 +612,10 @@ class WanModel(ModelMixin, ConfigMixin):
         self.slg_end_percent = 1.0
 
         self.use_non_blocking = True
+        self.prefetch_stream = None
+        self.offload_stream = None
+        self.block_onload_events = {}
+        self.block_offload_events = {}
 
         # embeddings
         self.patch_embedding = nn.Conv3d(
@@ -665,9 +679,16 @@ class WanModel(ModelMixin, ConfigMixin):
                 block.to(self.main_device)
                 total_main_memory += block_memory
             else:
-                block.to(self.offload_device, non_blocking=self.use_non_blocking)
+                if self.use_non_blocking:
+                    # blocking move so the host tensors are complete before they are copied into the pool
+                    block.to(self.offload_device)
+                    self.pin_block(block)
+                else:
+                    block.to(self.offload_device)
                 total_offload_memory += block_memory
 
+        self.block_onload_events = {}
+        self.block_offload_events = {}
         mm.soft_empty_cache()
         gc.collect()
                 
@@ -680,6 +701,93 @@ class WanModel(ModelMixin, ConfigMixin):
         log.info(f"Non-blocking memory transfer: {self.use_non_blocking}")
         log.info("----------------------")
 
+    def block_tensors(self, block):
+        # buffers (e.g. fp8 row scales) have to follow the weights when swapping
+        return itertools.chain(block.parameters(), block.buffers())
+
+    def pin_block(self, block):
+        # one pinned allocation per block with the tensors as views into it, instead of a pinned
+        # allocation per tensor, which the caching host allocator rounds up to a power of two,
+        # tensors that are already pinned are pooled too so every block ends up in one allocation
+        tensors = [t for t in self.block_tensors(block) if t.device.type == "cpu" and type(t.data) is torch.Tensor]
+        if not tensors:
+            return
+        align = 64
+        sizes = [(t.numel() * t.element_size() + align - 1) // align * align for t in tensors]
+        pool = torch.empty(sum(sizes), dtype=torch.uint8, pin_memory=True)
+        offset = 0
+        for t, size in zip(tensors, sizes):
+            nbytes = t.numel() * t.element_size()
+            view = pool[offset:offset + nbytes].view(t.dtype).view(t.shape)
+            view.copy_(t.data)
+            t.data = view
+            offset += size
+
+    def use_block_prefetch(self):
+        return self.blocks_to_swap >= 0 and self.use_non_blocking and torch.device(self.main_device).type == "cuda"
+
+    def prefetch_block(self, b):
+        # async H2D of a swapped block on the side stream, from the pinned buffers kept on the parameters
+        if self.prefetch_stream is None:
+            self.prefetch_stream = torch.cuda.Stream(device=self.main_device)
+        with torch.cuda.stream(self.prefetch_stream):
+            if b in self.block_offload_events:
+                self.prefetch_stream.wait_event(self.block_offload_events.pop(b))
+            for param in self.block_tensors(self.blocks[b]):
+                if param.device.type == "cpu":
+                    cpu_data = param.data if param.data.is_pinned() else param.data.pin_memory()
+                    param.swap_cpu_data = cpu_data
+                    param.data = cpu_data.to(self.main_device, non_blocking=True)
+                    param.swap_device_ptr = param.data_ptr()
+            event = torch.cuda.Event()
+            event.record(self.prefetch_stream)
+        self.block_onload_events[b] = event
+
+    def wait_for_block(self, b):
+        current_stream = torch.cuda.current_stream(self.main_device)
+        # also covers a stale prefetch, e.g. after the whole model was moved to the offload device
+        if b not in self.block_onload_events or next(self.blocks[b].parameters()).device.type == "cpu":
+            self.prefetch_block(b)
+        current_stream.wait_event(self.block_onload_events.pop(b))
+        for param in self.block_tensors(self.blocks[b]):
+            if param.device.type != "cpu":
+                param.data.record_stream(current_stream)
+
+    def offload_block(self, b):
+        # the pinned buffer a tensor was uploaded from still holds the same weights, so unless the
+        # tensor was replaced on the device since, offloading only drops the device copy
+        copy_back = []
+        for param in self.block_tensors(self.blocks[b]):
+            if param.device.type == "cpu":
+                continue
+            cpu_data = getattr(param, "swap_cpu_data", None)
+            if cpu_data is not None and getattr(param, "swap_device_ptr", None) == param.data_ptr() \
+                and cpu_data.shape == param.shape and cpu_data.dtype == param.dtype:
+                param.data = cpu_data
+                param.swap_device_ptr = None
+            else:
+                copy_back.append(param)
+        if not copy_back:
+            return
+
+        # the rest is copied back on its own stream once the block is done, so it doesn't hold up the next block
+        if self.offload_stream is None:
+            self.offload_stream = torch.cuda.Stream(device=self.main_device)
+        self.offload_stream.wait_stream(torch.cuda.current_stream(self.main_device))
+        with torch.cuda.stream(self.offload_stream):
+            for param in copy_back:
+                cpu_data = getattr(param, "swap_cpu_data", None)
+                if cpu_data is None or cpu_data.shape != param.shape or cpu_data.dtype != param.dtype:
+                    cpu_data = torch.empty_like(param.data, device="cpu", pin_memory=True)
+                param.data.record_stream(self.offload_stream)
+                cpu_data.copy_(param.data, non_blocking=True)
+                param.swap_cpu_data = cpu_data
+                param.data = cpu_data
+                param.swap_device_ptr = None
+            event = torch.cuda.Event()
+            event.record(self.offload_stream)
+        self.block_offload_events[b] = event
+
     def forward(
         self,
         x,
@@ -805,14 +913,14 @@ class WanModel(ModelMixin, ConfigMixin):
                 #log.info(f"TeaCache: Initializing TeaCache variables for model pred: {pred_id}")
                 should_calc = True                
             else:
-                previous_modulated_input = self.teacache_state.get(pred_id)['previous_modulated_input']
-                previous_modulated_input = previous_modulated_input.to(device)
-                previous_residual = self.teacache_state.get(pred_id)['previous_residual']
+                previous_modulated_input = self.teacache_state.get_tensor(pred_id, 'previous_modulated_input', device)
                 accumulated_rel_l1_distance = self.teacache_state.get(pred_id)['accumulated_rel_l1_distance']
 
                 if self.teacache_use_coefficients:
-                    rescale_func = np.poly1d(self.teacache_coefficients)
-                    accumulated_rel_l1_distance += rescale_func(((e-previous_modulated_input).abs().mean() / previous_modulated_input.abs().mean()).cpu().item())
+                    if self.teacache_coeffs.device != device:
+                        self.teacache_coeffs = self.teacache_coeffs.to(device)
+                    rel_l1 = ((e-previous_modulated_input).abs().mean() / previous_modulated_input.abs().mean()).float()
+                    accumulated_rel_l1_distance = accumulated_rel_l1_distance + teacache_poly(rel_l1, self.teacache_coeffs)
                 else:
                     temb_relative_l1 = relative_l1_distance(previous_modulated_input, e0)
                     accumulated_rel_l1_distance = accumulated_rel_l1_distance.to(e0.device) + temb_relative_l1
@@ -827,7 +935,7 @@ class WanModel(ModelMixin, ConfigMixin):
 
             previous_modulated_input = e.clone() if self.teacache_use_coefficients else e0.clone()
             if not should_calc:
-                x += previous_residual.to(x.device)
+                x += self.teacache_state.get_tensor(pred_id, 'previous_residual', x.device)
                 #log.info(f"TeaCache: Skipping uncond step {current_step+1}")
                 self.teacache_state.update(
                     pred_id,
@@ -849,16 +957,32 @@ class WanModel(ModelMixin, ConfigMixin):
                 rope_func=rope_func
                 )
 
+            block_prefetch = self.use_block_prefetch()
             for b, block in enumerate(self.blocks):
+                swapped = b <= self.blocks_to_swap and self.blocks_to_swap >= 0
+                if block_prefetch and b + 1 <= self.blocks_to_swap and b + 1 < len(self.blocks):
+                    self.prefetch_block(b + 1)
                 if self.slg_blocks is not None:
                     if b in self.slg_blocks and is_uncond:
                         if self.slg_start_percent <= current_step_percentage <= self.slg_end_percent:
+                            if block_prefetch and b in self.block_onload_events:
+                                self.wait_for_block(b)
+                                self.offload_block(b)
                             continue
-                if b <= self.blocks_to_swap and self.blocks_to_swap >= 0:
-                    block.to(self.main_device)
+                if swapped:
+                    if block_prefetch:
+                        self.wait_for_block(b)
+                    else:
+                        block.to(self.main_device)
                 x = block(x, **kwargs)
-                if b <= self.blocks_to_swap and self.blocks_to_swap >= 0:
-                    block.to(self.offload_device, non_blocking=self.use_non_blocking)
+                if swapped:
+                    if block_prefetch:
+                        self.offload_block(b)
+                    else:
+                        block.to(self.offload_device, non_blocking=self.use_non_blocking)
+            if block_prefetch:
+                # wrap around, the first block uploads while the head and the next step's embeddings run
+                self.prefetch_block(0)
 
             if self.enable_teacache and pred_id is not None:
                 self.teacache_state.update(
@@ -907,6 +1031,10 @@ class TeaCacheState:
         log.info(f"TeaCache: Using cache device: {self.cache_device}")
         self.states = {}
         self._next_pred_id = 0
+        # pinned host buffers per (pred_id, key), written asynchronously on copy_stream
+        self.pinned_buffers = {}
+        self.copy_events = {}
+        self.copy_stream = None
     
     def new_prediction(self):
         """Create new prediction state and return its ID"""
@@ -926,8 +1054,35 @@ class TeaCacheState:
             return None
         for key, value in kwargs.items():
             if isinstance(value, torch.Tensor):
-                value = value.to(self.cache_device)
+                value = self._to_cache_device(pred_id, key, value)
             self.states[pred_id][key] = value
+
+    def _to_cache_device(self, pred_id, key, value):
+        # scalars are read on the host right away, only offload the large tensors asynchronously
+        if value.dim() == 0 or value.device.type != "cuda" or torch.device(self.cache_device).type != "cpu":
+            return value.to(self.cache_device)
+        buffer = self.pinned_buffers.get((pred_id, key))
+        if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+            buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            self.pinned_buffers[(pred_id, key)] = buffer
+        if self.copy_stream is None:
+            self.copy_stream = torch.cuda.Stream(device=value.device)
+        self.copy_stream.wait_stream(torch.cuda.current_stream(value.device))
+        with torch.cuda.stream(self.copy_stream):
+            buffer.copy_(value, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.copy_stream)
+        value.record_stream(self.copy_stream)
+        self.copy_events[(pred_id, key)] = event
+        return buffer
+
+    def get_tensor(self, pred_id, key, device):
+        """Get a cached tensor on the given device, waiting for a pending asynchronous store first"""
+        value = self.states[pred_id][key]
+        event = self.copy_events.pop((pred_id, key), None)
+        if event is not None:
+            torch.cuda.current_stream(device).wait_event(event)
+        return value.to(device, non_blocking=value.is_pinned())
     
     def get(self, pred_id):
         return self.states.get(pred_id, {})
@@ -939,9 +1094,16 @@ class TeaCacheState:
     def clear_prediction(self, pred_id):
         if pred_id in self.states:
             del self.states[pred_id]
+        for key in [k for k in self.pinned_buffers if k[0] == pred_id]:
+            del self.pinned_buffers[key]
+            self.copy_events.pop(key, None)
     
     def clear_all(self):
+        if self.copy_stream is not None:
+            self.copy_stream.synchronize()
         self.states.clear()
+        self.pinned_buffers.clear()
+        self.copy_events.clear()
         self._next_pred_id = 0
 
 def relative_l1_distance(last_tensor, current_tensor):
@@ -512,8 +512,37 @@ class T5EncoderModel:
     def __call__(self, texts, device):
         ids, mask = self.tokenizer(
             texts, return_mask=True, add_special_tokens=True)
-        ids = ids.to(device)
-        mask = mask.to(device)
         seq_lens = mask.gt(0).sum(dim=1).long()
+        device = torch.device(device)
+        if len(texts) <= 3 or device.type != "cuda":
+            return self.encode(ids, mask, seq_lens, device)
+
+        # many prompts: split into a short and a long bucket by token count, each is trimmed
+        # to its own length and the two run concurrently on their own streams
+        order = sorted(range(len(texts)), key=lambda i: seq_lens[i].item())
+        buckets = [order[:len(order) // 2], order[len(order) // 2:]]
+        current_stream = torch.cuda.current_stream(device)
+        context = [None] * len(texts)
+        streams = []
+        for bucket in buckets:
+            stream = torch.cuda.Stream(device=device)
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                out = self.encode(ids[bucket], mask[bucket], seq_lens[bucket], device)
+            for i, u in zip(bucket, out):
+                context[i] = u
+            streams.append(stream)
+        for stream in streams:
+            current_stream.wait_stream(stream)
+        for u in context:
+            u.record_stream(current_stream)
+        return context
+
+    def encode(self, ids, mask, seq_lens, device):
+        # the tokenizer pads to text_len, padding is masked out and the position bias is relative,
+        # so trimming to the longest prompt in the batch gives the same embeddings
+        max_len = int(seq_lens.max())
+        ids = ids[:, :max_len].to(device)
+        mask = mask[:, :max_len].to(device)
         context = self.model(ids, mask)
-        return [u[:v] for u, v in zip(context, seq_lens)]
+        return [u[:v] for u, v in zip(context, seq_lens.tolist())]